@@ -1,19 +1,16 @@
-from chroma_utils import query_collections
-from openai import OpenAI
-from dotenv import load_dotenv
-import os
+from chroma_utils import query_collections_async, query_collections_batch_async, llm_complete_async, submit_batch, select_context_chunks, summarize_for_history
 from collections import deque
+from itertools import chain
 import json
 import re
+import asyncio
+import heapq
+import functools
 
-# Load .env file
-load_dotenv()
-
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-except Exception as e:
-    raise ValueError(f"Failed to initialize OpenAI client: {str(e)}")
+# Precompiled parsers for query analysis and LLM output
+_SPLIT_RE = re.compile(r'[.;]\s*and\s*|[.;]\s*', re.IGNORECASE)
+_AND_RE = re.compile(r'\band\b', re.IGNORECASE)
+_JSON_DECODER = json.JSONDecoder()
 
 class AgenticRAG:
     def __init__(self, max_history=5):
@@ -23,17 +20,22 @@ class AgenticRAG:
         Args:
             max_history (int): Maximum number of conversation turns to store (default: 5).
         """
-        self.history = deque(maxlen=max_history)  # Stores (query, response) pairs; remove if not needed
+        self.history = deque(maxlen=max_history)  # Preformatted turns, oldest dropped first; remove if not needed
+        self._turn = 0  # Running turn number across the rolling window
+        self._history_cache = None  # Rendered history; reset on every add_to_history
+        self.batch_prompts = []  # Prompts queued when fine_tune_mode="batch"
 
     def add_to_history(self, query, response):
         """
-        Adds query and response to the conversation history.
+        Adds query and a truncated response to the conversation history, keeping prompts small.
         
         Args:
             query (str): User query.
             response (str): RAG response (raw or fine-tuned).
         """
-        self.history.append((query, response))
+        self._turn += 1
+        self.history.append(f"Turn {self._turn} - Query: {query}\nResponse: {summarize_for_history(response)}\n\n")
+        self._history_cache = None
 
     def get_history_context(self):
         """
@@ -44,66 +46,121 @@ class AgenticRAG:
         """
         if not self.history:
             return ""
-        context = "Conversation History:\n"
-        for i, (query, response) in enumerate(self.history, 1):
-            context += f"Turn {i} - Query: {query}\nResponse: {response}\n\n"
-        return context
+        if self._history_cache is None:
+            self._history_cache = "Conversation History:\n" + "".join(self.history)
+        return self._history_cache
+
+    def submit_pending_batch(self):
+        """
+        Submits prompts queued with fine_tune_mode="batch" as one OpenAI Batch API job.
+        
+        Returns:
+            str: Batch id (collect answers with chroma_utils.collect_batch), or None if nothing was queued.
+        """
+        if not self.batch_prompts:
+            return None
+        batch_id = submit_batch(self.batch_prompts)
+        if batch_id:
+            self.batch_prompts = []
+        return batch_id
 
-    def analyze_query(self, query):
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def analyze_query(query):
         """
-        Analyzes query complexity and suggests retrieval strategy.
+        Analyzes query complexity and suggests retrieval strategy. Results are cached per query string.
         
         Args:
             query (str): User question.
         
         Returns:
-            tuple: (is_complex, sub_queries) where is_complex is bool and sub_queries is list of str.
+            tuple: (is_complex, sub_queries) where is_complex is bool and sub_queries is tuple of str.
         """
         print(f"Analyzing Query: {query}")
         # Simple heuristic: Split by 'and' or multi-sentence queries
-        if "and" in query.lower() or query.count(".") > 1:
+        if _AND_RE.search(query) or query.count(".") > 1:
             print("Query identified as complex; splitting into sub-queries.")
-            sub_queries = re.split(r'[.;]\s*and\s*|[.;]\s*', query)
-            sub_queries = [q.strip() for q in sub_queries if q.strip()]
-            return True, sub_queries
+            sub_queries = _SPLIT_RE.split(query)
+            return True, tuple(q.strip() for q in sub_queries if q.strip())
         print("Query identified as simple; proceeding with direct retrieval.")
-        return False, [query]
+        return False, (query,)
+
+    def agentic_rag(self, query, collections, top_k=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
+        """
+        Synchronous wrapper around agentic_rag_async for callers without an event loop.
+        
+        Args:
+            query (str): User question.
+            collections (list): List of ChromaDB collections (one per PDF).
+            top_k (int): Number of top relevant chunks to retrieve (default: 3).
+            fine_tune (bool): If True, use LLM for structured output; if False, direct JSON structuring (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
+        
+        Returns:
+            str: Agent reasoning and structured JSON response.
+        """
+        return asyncio.run(self.agentic_rag_async(query, collections, top_k, fine_tune, ctx_top_n, fine_tune_mode))
 
-    def agentic_rag(self, query, collections, top_k=3, fine_tune=False):
+    async def agentic_rag_async(self, query, collections, top_k=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
         """
         Performs Agentic RAG with dynamic query handling and structured output.
+        Sub-queries are embedded and retrieved in a single batched query per collection.
         
         Args:
             query (str): User question.
             collections (list): List of ChromaDB collections (one per PDF).
             top_k (int): Number of top relevant chunks to retrieve (default: 3).
             fine_tune (bool): If True, use LLM for structured output; if False, direct JSON structuring (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
         
         Returns:
             str: Agent reasoning and structured JSON response.
         """
+        return "".join([token async for token in self.agentic_rag_stream(query, collections, top_k, fine_tune, ctx_top_n, fine_tune_mode)])
+
+    async def agentic_rag_stream(self, query, collections, top_k=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
+        """
+        Streaming variant of agentic_rag; yields the response as it is generated.
+        Sub-queries are embedded and retrieved in a single batched query per collection.
+        
+        Args:
+            query (str): User question.
+            collections (list): List of ChromaDB collections (one per PDF).
+            top_k (int): Number of top relevant chunks to retrieve (default: 3).
+            fine_tune (bool): If True, use LLM for structured output; if False, direct JSON structuring (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
+        
+        Yields:
+            str: Fragments of the response; LLM tokens are yielded as they arrive.
+        """
         try:
             if not collections:
-                return "No document collections available to query."
+                yield "No document collections available to query."
+                return
             if not query:
-                return "No query provided."
+                yield "No query provided."
+                return
             
             # Agent reasoning
             is_complex, sub_queries = self.analyze_query(query)
+            sub_queries = list(sub_queries)
             all_results = []
             reasoning_steps = ["Agent Reasoning: Initial query analysis completed."]
             
             if is_complex:
                 reasoning_steps.append(f"Query split into {len(sub_queries)} sub-queries: {sub_queries}")
-                for sub_query in sub_queries:
-                    results = query_collections(sub_query, collections, top_k)
+                results_list = await query_collections_batch_async(sub_queries, collections, top_k, hybrid=True)
+                for sub_query, results in zip(sub_queries, results_list):
                     if results:
                         all_results.extend(results)
                         reasoning_steps.append(f"Retrieved {len(results)} chunks for sub-query: {sub_query}")
                     else:
                         reasoning_steps.append(f"No results for sub-query: {sub_query}")
             else:
-                results = query_collections(query, collections, top_k)
+                results = await query_collections_async(query, collections, top_k, hybrid=True)
                 if results:
                     all_results.extend(results)
                     reasoning_steps.append(f"Retrieved {len(results)} chunks for query: {query}")
@@ -111,52 +168,58 @@ class AgenticRAG:
                     reasoning_steps.append(f"No results for query: {query}")
             
             if not all_results:
-                return "\n".join(reasoning_steps) + "\nNo relevant documents found."
+                yield "\n".join(reasoning_steps) + "\nNo relevant documents found."
+                return
 
-            # Deduplicate and sort by similarity
-            chunk_ids = set()
-            unique_results = []
+            # Deduplicate (keeping the best match per chunk) and select the top_k by similarity
+            best = {}
             for result in all_results:
-                if result["metadata"]["chunk_id"] not in chunk_ids:
-                    chunk_ids.add(result["metadata"]["chunk_id"])
-                    unique_results.append(result)
-            unique_results = sorted(unique_results, key=lambda x: x["similarity"], reverse=True)[:top_k]
+                chunk_id = result.chunk_id
+                cur = best.get(chunk_id)
+                if cur is None or result.similarity > cur.similarity:
+                    best[chunk_id] = result
+            unique_results = heapq.nlargest(top_k, best.values(), key=lambda x: x.similarity)
 
+            # Only the top ctx_top_n chunks go into the LLM context to keep input tokens down
+            context_ids = {r.chunk_id for r in select_context_chunks(query, unique_results, ctx_top_n)}
             # Construct context and raw response
-            raw_response = ""
-            context = ""
+            raw_parts = []
+            context_parts = []
             print("\nRetrieved Chunks:")
             for i, result in enumerate(unique_results):
-                doc = result["document"]
-                metadata = result["metadata"]
-                similarity = result["similarity"]
-                page_numbers = metadata.get("page_numbers", [])
-                filename = metadata.get("filename", "unknown")
-                page_ref = f"Pages {', '.join(map(str, page_numbers))}" if page_numbers else "No page info"
+                doc = result.doc
+                similarity = result.similarity
+                filename = result.filename
+                page_ref = result.page_ref
                 # print(f"Chunk {i+1} (Cosine Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):")
                 # print(f"{doc[:200]}..." if len(doc) > 200 else doc)
                 # print("-" * 50)
                 chunk_text = f"Chunk {i+1} (Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):\n{doc}\n"
-                raw_response += chunk_text
-                context += f"Document {i+1} ({page_ref}, PDF: {filename}):\n{doc}\n\n"
+                raw_parts.append(chunk_text)
+                if result.chunk_id in context_ids:
+                    context_parts.append(f"Document {i+1} ({page_ref}, PDF: {filename}):\n{doc}\n\n")
+            raw_response = "".join(raw_parts)
+            context = "".join(context_parts)
             
             # Direct structuring when fine_tune=False
             if not fine_tune:
-                best_result = max(unique_results, key=lambda x: x["similarity"])
-                summary = best_result["document"][:200] + "..." if len(best_result["document"]) > 200 else best_result["document"]
-                all_pages = [page for result in unique_results for page in result["metadata"]["page_numbers"]]
-                source = best_result["metadata"]["filename"]
+                best_result = max(unique_results, key=lambda x: x.similarity)
+                summary = best_result.doc[:200] + "..." if len(best_result.doc) > 200 else best_result.doc
+                all_pages = list(dict.fromkeys(chain.from_iterable(result.page_numbers for result in unique_results)))
+                source = best_result.filename
                 structured_response = {
                     "question": query,
                     "answer": {
                         "summary": summary,
                         "details": raw_response,
-                        "pages": list(set(all_pages)),
+                        "pages": all_pages,
                         "source": source
                     }
                 }
-                self.add_to_history(query, json.dumps(structured_response))  # Remove if disabling history
-                return "\n".join(reasoning_steps) + f"\n\nStructured Output RAG Response:\n{json.dumps(structured_response, indent=2)}"
+                payload = json.dumps(structured_response, indent=2)
+                self.add_to_history(query, payload)  # Remove if disabling history
+                yield "\n".join(reasoning_steps) + f"\n\nStructured Output RAG Response:\n{payload}"
+                return
 
             # LLM structuring when fine_tune=True
             history_context = self.get_history_context()  # Remove if disabling history
@@ -184,29 +247,31 @@ class AgenticRAG:
             
           
 
-            # Generate structured response using OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=1000,
-                temperature=0.7
-            )
+            # Queue for the OpenAI Batch API instead of calling the LLM now
+            if fine_tune_mode == "batch":
+                self.batch_prompts.append(prompt)
+                yield f"\nQueued for batch generation as request-{len(self.batch_prompts) - 1}"
+                return
+
+            # Generate structured response using OpenAI, streaming tokens as they arrive
+            tokens = await llm_complete_async(prompt, stream=True)
             
-            structured_answer = response.choices[0].message.content.strip()
+            yield "\n".join(reasoning_steps) + "\n\nStructured Output RAG Response:\n"
+            answer_parts = []
+            async for token in tokens:
+                answer_parts.append(token)
+                yield token
+            structured_answer = "".join(answer_parts).strip()
             print(f"Raw LLM Response: {structured_answer}")  # Debug log
             
-            # Extract JSON using regex to handle potential extra text
-            json_match = re.search(r'\{.*\}', structured_answer, re.DOTALL)
-            if json_match:
-                structured_answer = json_match.group(0).strip()
-            
             try:
-                # Validate JSON
-                parsed_json = json.loads(structured_answer)
+                # Locate and validate the first JSON object in one pass to handle potential extra text
+                start = max(structured_answer.find("{"), 0)
+                _, end = _JSON_DECODER.raw_decode(structured_answer, start)
+                structured_answer = structured_answer[start:end]
                 self.add_to_history(query, structured_answer)  # Remove if disabling history
-                return "\n".join(reasoning_steps) + f"\n\nStructured Output RAG Response:\n{json.dumps(parsed_json, indent=2)}"
             except json.JSONDecodeError as e:
-                return "\n".join(reasoning_steps) + f"\n\nError: Invalid JSON response from LLM:\n{structured_answer}\nError Details: {str(e)}"
+                yield f"\n\nError: Invalid JSON response from LLM\nError Details: {str(e)}"
         
         except Exception as e:
-            return f"Error processing query: {str(e)}"
\ No newline at end of file
+            yield f"Error processing query: {str(e)}"
\ No newline at end of file
@@ -1,18 +1,6 @@
-from chroma_utils import query_collections
-from openai import OpenAI
-from dotenv import load_dotenv
-import os
+from chroma_utils import query_collections, llm_complete, submit_batch, select_context_chunks, summarize_for_history
 from collections import deque
 
-# Load .env file
-load_dotenv()
-
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-except Exception as e:
-    raise ValueError(f"Failed to initialize OpenAI client: {str(e)}")
-
 class ConversationalRAG:
     def __init__(self, max_history=5):
         """
@@ -21,17 +9,22 @@ class ConversationalRAG:
         Args:
             max_history (int): Maximum number of conversation turns to store (default: 5).
         """
-        self.history = deque(maxlen=max_history)  # Stores (query, response) pairs
+        self.history = deque(maxlen=max_history)  # Preformatted turns, oldest dropped first
+        self._turn = 0  # Running turn number across the rolling window
+        self._history_cache = None  # Rendered history; reset on every add_to_history
+        self.batch_prompts = []  # Prompts queued when fine_tune_mode="batch"
 
     def add_to_history(self, query, response):
         """
-        Adds a query and response to the conversation history.
+        Adds a query and a truncated response to the conversation history, keeping prompts small.
         
         Args:
             query (str): User's query.
             response (str): RAG response (raw or fine-tuned).
         """
-        self.history.append((query, response))
+        self._turn += 1
+        self.history.append(f"Turn {self._turn} - Query: {query}\nResponse: {summarize_for_history(response)}\n\n")
+        self._history_cache = None
 
     def get_history_context(self):
         """
@@ -42,12 +35,25 @@ class ConversationalRAG:
         """
         if not self.history:
             return ""
-        context = "Conversation History:\n"
-        for i, (query, response) in enumerate(self.history, 1):
-            context += f"Turn {i} - Query: {query}\nResponse: {response}\n\n"
-        return context
+        if self._history_cache is None:
+            self._history_cache = "Conversation History:\n" + "".join(self.history)
+        return self._history_cache
 
-    def conversational_rag(self, query, collections, top_k=3, fine_tune=False):
+    def submit_pending_batch(self):
+        """
+        Submits prompts queued with fine_tune_mode="batch" as one OpenAI Batch API job.
+        
+        Returns:
+            str: Batch id (collect answers with chroma_utils.collect_batch), or None if nothing was queued.
+        """
+        if not self.batch_prompts:
+            return None
+        batch_id = submit_batch(self.batch_prompts)
+        if batch_id:
+            self.batch_prompts = []
+        return batch_id
+
+    def conversational_rag(self, query, collections, top_k=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
         """
         Performs Conversational RAG with history, querying ChromaDB collections, and optional LLM fine-tuning.
         
@@ -56,40 +62,65 @@ class ConversationalRAG:
             collections (list): List of ChromaDB collections to query.
             top_k (int): Number of top relevant chunks to retrieve (default: 3).
             fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
         
         Returns:
             str: Raw or fine-tuned RAG response with page references.
         """
+        return "".join(self.conversational_rag_stream(query, collections, top_k, fine_tune, ctx_top_n, fine_tune_mode))
+
+    def conversational_rag_stream(self, query, collections, top_k=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
+        """
+        Streaming variant of conversational_rag; yields the response as it is generated.
+        
+        Args:
+            query (str): User's question.
+            collections (list): List of ChromaDB collections to query.
+            top_k (int): Number of top relevant chunks to retrieve (default: 3).
+            fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
+        
+        Yields:
+            str: Fragments of the raw or fine-tuned RAG response; LLM tokens are yielded as they arrive.
+        """
         try:
             if not collections:
-                return "No document collections available to query."
+                yield "No document collections available to query."
+                return
             
             # Query collections to get relevant chunks, metadata, and similarity scores
             results = query_collections(query, collections, top_k)
             if not results:
-                return "No relevant documents found for the query."
+                yield "No relevant documents found for the query."
+                return
             
+            # Only the top ctx_top_n chunks go into the LLM context to keep input tokens down
+            context_ids = {r.chunk_id for r in select_context_chunks(query, results, ctx_top_n)}
             # Construct raw RAG response and print retrieved chunks
-            raw_response = ""
-            context = ""
+            raw_parts = []
+            context_parts = []
             print("\nRetrieved Chunks:")
             for i, result in enumerate(results):
-                doc = result["document"]
-                metadata = result["metadata"]
-                similarity = result["similarity"]
-                page_numbers = metadata.get("page_numbers", [])
-                page_ref = f"Pages {', '.join(map(str, page_numbers))}" if page_numbers else "No page info"
+                doc = result.doc
+                similarity = result.similarity
+                page_ref = result.page_ref
                 # print(f"Chunk {i+1} (Cosine Similarity: {similarity:.3f}, {page_ref}):")
                 # print(f"{doc[:200]}..." if len(doc) > 200 else doc)
                 # print("-" * 50)
                 chunk_text = f"Chunk {i+1} (Similarity: {similarity:.3f}, {page_ref}):\n{doc}\n"
-                raw_response += chunk_text
-                context += f"Document {i+1} ({page_ref}):\n{doc}\n\n"
+                raw_parts.append(chunk_text)
+                if result.chunk_id in context_ids:
+                    context_parts.append(f"Document {i+1} ({page_ref}):\n{doc}\n\n")
+            raw_response = "".join(raw_parts)
+            context = "".join(context_parts)
             
             # If fine_tune is False, add to history and return raw response
             if not fine_tune:
                 self.add_to_history(query, raw_response)
-                return f"\nRaw RAG Response:\n{raw_response}"
+                yield f"\nRaw RAG Response:\n{raw_response}"
+                return
             
             # If fine_tune is True, construct prompt with history and context
             history_context = self.get_history_context()
@@ -104,17 +135,22 @@ class ConversationalRAG:
                         referencing relevant page numbers if applicable:
                         """
             
-            # Generate response using OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=1000,
-                temperature=0.7
-            )
+            # Queue for the OpenAI Batch API instead of calling the LLM now
+            if fine_tune_mode == "batch":
+                self.batch_prompts.append(prompt)
+                yield f"\nQueued for batch generation as request-{len(self.batch_prompts) - 1}"
+                return
+
+            # Generate response using OpenAI, streaming tokens as they arrive
+            tokens = llm_complete(prompt, stream=True)
             
-            answer = response.choices[0].message.content.strip()
+            yield "\nFine-Tuned RAG Answer:\n"
+            answer_parts = []
+            for token in tokens:
+                answer_parts.append(token)
+                yield token
+            answer = "".join(answer_parts).strip()
             self.add_to_history(query, answer)
-            return f"\nFine-Tuned RAG Answer:\n{answer}"
         
         except Exception as e:
-            return f"Error processing query: {str(e)}"
\ No newline at end of file
+            yield f"Error processing query: {str(e)}"
\ No newline at end of file
@@ -1,17 +1,7 @@
-from chroma_utils import query_collections
-from openai import OpenAI
-from dotenv import load_dotenv
-import os
+from chroma_utils import query_collections, embed_query, get_collection_stats, llm_complete, submit_batch, select_context_chunks, summarize_for_history
 from collections import deque
-
-# Load .env file
-load_dotenv()
-
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-except Exception as e:
-    raise ValueError(f"Failed to initialize OpenAI client: {str(e)}")
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 
 class HierarchicalRAG:
     def __init__(self, max_history=5):
@@ -21,17 +11,22 @@ class HierarchicalRAG:
         Args:
             max_history (int): Maximum number of conversation turns to store (default: 5).
         """
-        self.history = deque(maxlen=max_history)  # Stores (query, response) pairs; remove if not needed
+        self.history = deque(maxlen=max_history)  # Preformatted turns, oldest dropped first; remove if not needed
+        self._turn = 0  # Running turn number across the rolling window
+        self._history_cache = None  # Rendered history; reset on every add_to_history
+        self.batch_prompts = []  # Prompts queued when fine_tune_mode="batch"
 
     def add_to_history(self, query, response):
         """
-        Adds query and response to the conversation history.
+        Adds query and a truncated response to the conversation history, keeping prompts small.
         
         Args:
             query (str): User query.
             response (str): RAG response (raw or fine-tuned).
         """
-        self.history.append((query, response))
+        self._turn += 1
+        self.history.append(f"Turn {self._turn} - Query: {query}\nResponse: {summarize_for_history(response)}\n\n")
+        self._history_cache = None
 
     def get_history_context(self):
         """
@@ -42,12 +37,25 @@ class HierarchicalRAG:
         """
         if not self.history:
             return ""
-        context = "Conversation History:\n"
-        for i, (query, response) in enumerate(self.history, 1):
-            context += f"Turn {i} - Query: {query}\nResponse: {response}\n\n"
-        return context
+        if self._history_cache is None:
+            self._history_cache = "Conversation History:\n" + "".join(self.history)
+        return self._history_cache
 
-    def hierarchical_rag(self, query, collections, top_k_coarse=2, top_k_fine=3, fine_tune=False):
+    def submit_pending_batch(self):
+        """
+        Submits prompts queued with fine_tune_mode="batch" as one OpenAI Batch API job.
+        
+        Returns:
+            str: Batch id (collect answers with chroma_utils.collect_batch), or None if nothing was queued.
+        """
+        if not self.batch_prompts:
+            return None
+        batch_id = submit_batch(self.batch_prompts)
+        if batch_id:
+            self.batch_prompts = []
+        return batch_id
+
+    def hierarchical_rag(self, query, collections, top_k_coarse=2, top_k_fine=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
         """
         Performs Hierarchical RAG with coarse and fine retrieval levels.
         
@@ -57,63 +65,94 @@ class HierarchicalRAG:
             top_k_coarse (int): Number of top PDFs to select at coarse level (default: 2).
             top_k_fine (int): Number of top chunks per PDF at fine level (default: 3).
             fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
         
         Returns:
             str: Raw or fine-tuned RAG response with hierarchical references.
         """
+        return "".join(self.hierarchical_rag_stream(query, collections, top_k_coarse, top_k_fine, fine_tune, ctx_top_n, fine_tune_mode))
+
+    def hierarchical_rag_stream(self, query, collections, top_k_coarse=2, top_k_fine=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
+        """
+        Streaming variant of hierarchical_rag; yields the response as it is generated.
+        
+        Args:
+            query (str): User question.
+            collections (list): List of ChromaDB collections (one per PDF).
+            top_k_coarse (int): Number of top PDFs to select at coarse level (default: 2).
+            top_k_fine (int): Number of top chunks per PDF at fine level (default: 3).
+            fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
+        
+        Yields:
+            str: Fragments of the raw or fine-tuned RAG response; LLM tokens are yielded as they arrive.
+        """
         try:
             if not collections:
-                return "No document collections available to query."
+                yield "No document collections available to query."
+                return
             if not query:
-                return "No query provided."
+                yield "No query provided."
+                return
             
-            # Coarse Retrieval: Select top PDFs based on metadata (e.g., page count as a proxy)
-            coarse_results = []
-            for collection in collections:
-                metadata = collection.get(include=["metadatas"])["metadatas"]
-                if metadata:
-                    avg_page_count = sum(meta.get("page_count", 0) for meta in metadata) / len(metadata) if metadata else 0
-                    coarse_results.append({"collection": collection, "page_count": avg_page_count, "filename": metadata[0].get("filename", "unknown")})
-            coarse_results = sorted(coarse_results, key=lambda x: x["page_count"], reverse=True)[:top_k_coarse]
-            print(f"Coarse Selection: {[f'{res["filename"]} ({res["page_count"]} pages)' for res in coarse_results]}")
+            # Coarse Retrieval: Select top PDFs based on cached collection stats (page count as a proxy)
+            coarse_results = heapq.nlargest(
+                top_k_coarse,
+                ({"collection": collection, **get_collection_stats(collection)} for collection in collections),
+                key=lambda x: x["page_count"]
+            )
+            coarse_summary = [f"{res['filename']} ({res['page_count']} pages)" for res in coarse_results]
+            print(f"Coarse Selection: {coarse_summary}")
             
-            # Fine Retrieval: Query selected collections
-            fine_results = []
-            chunk_ids = set()
-            raw_response = ""
-            context = ""
-            for res in coarse_results:
-                results = query_collections(query, [res["collection"]], top_k_fine)
+            # Fine Retrieval: Query selected collections concurrently, keeping the best match per chunk
+            embed_query(query)  # Embed once up front so the concurrent queries all hit the query embedding cache
+            best = {}
+            with ThreadPoolExecutor(max_workers=max(len(coarse_results), 1)) as executor:
+                fine_batches = list(executor.map(
+                    lambda res: query_collections(query, [res["collection"]], top_k_fine), coarse_results
+                ))
+            for res, results in zip(coarse_results, fine_batches):
                 if not results:
                     continue
-                print(f"\nFine Retrieval for PDF: {res['filename']}")
-                for i, result in enumerate(results):
-                    chunk_id = result["metadata"]["chunk_id"]
-                    if chunk_id in chunk_ids:
-                        continue
-                    chunk_ids.add(chunk_id)
-                    doc = result["document"]
-                    metadata = result["metadata"]
-                    similarity = result["similarity"]
-                    page_numbers = metadata.get("page_numbers", [])
-                    filename = metadata.get("filename", "unknown")
-                    page_ref = f"Pages {', '.join(map(str, page_numbers))}" if page_numbers else "No page info"
-                    print(f"Chunk {i+1} (Cosine Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):")
-                    print(f"{doc[:200]}..." if len(doc) > 200 else doc)
-                    print("-" * 50)
-                    chunk_text = f"Chunk {i+1} (Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):\n{doc}\n"
-                    raw_response += chunk_text
-                    context += f"Document {i+1} ({page_ref}, PDF: {filename}):\n{doc}\n\n"
-                fine_results.extend(results)
+                print(f"\nFine Retrieval for PDF: {res['filename']}: {len(results)} chunks")
+                for result in results:
+                    chunk_id = result.chunk_id
+                    cur = best.get(chunk_id)
+                    if cur is None or result.similarity > cur.similarity:
+                        best[chunk_id] = result
+            fine_results = heapq.nlargest(top_k_coarse * top_k_fine, best.values(), key=lambda x: x.similarity)
+
+            # Only the top ctx_top_n chunks go into the LLM context to keep input tokens down
+            context_ids = {r.chunk_id for r in select_context_chunks(query, fine_results, ctx_top_n)}
+            raw_parts = []
+            context_parts = []
+            for i, result in enumerate(fine_results):
+                doc = result.doc
+                similarity = result.similarity
+                filename = result.filename
+                page_ref = result.page_ref
+                print(f"Chunk {i+1} (Cosine Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):")
+                print(f"{doc[:200]}..." if len(doc) > 200 else doc)
+                print("-" * 50)
+                chunk_text = f"Chunk {i+1} (Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):\n{doc}\n"
+                raw_parts.append(chunk_text)
+                if result.chunk_id in context_ids:
+                    context_parts.append(f"Document {i+1} ({page_ref}, PDF: {filename}):\n{doc}\n\n")
+            raw_response = "".join(raw_parts)
+            context = "".join(context_parts)
             
-            if not chunk_ids:
+            if not fine_results:
                 # self.add_to_history(query, raw_response)  # Remove if disabling history
-                return f"\nRaw Hierarchical RAG Response:\n{raw_response}\nNote: If relevant content is in images (e.g., graphs), consider OCR for text extraction."
+                yield f"\nRaw Hierarchical RAG Response:\n{raw_response}\nNote: If relevant content is in images (e.g., graphs), consider OCR for text extraction."
+                return
             
             # If fine_tune is False, return raw response
             if not fine_tune:
                 # self.add_to_history(query, raw_response)  # Remove if disabling history
-                return f"\nRaw Hierarchical RAG Response:\n{raw_response}"
+                yield f"\nRaw Hierarchical RAG Response:\n{raw_response}"
+                return
             
             # If fine_tune is True, construct prompt
             history_context = self.get_history_context()  # Remove if disabling history
@@ -137,17 +176,18 @@ class HierarchicalRAG:
             # Provide a detailed answer based on the retrieved context, referencing relevant page numbers and PDF filenames if applicable. Note that some PDFs may contain images (e.g., graphs) not included in the context:
             # """
 
-            # Generate response using OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=1000,
-                temperature=0.7
-            )
+            # Queue for the OpenAI Batch API instead of calling the LLM now
+            if fine_tune_mode == "batch":
+                self.batch_prompts.append(prompt)
+                yield f"\nQueued for batch generation as request-{len(self.batch_prompts) - 1}"
+                return
+
+            # Generate response using OpenAI, streaming tokens as they arrive
+            tokens = llm_complete(prompt, stream=True)
             
-            answer = response.choices[0].message.content.strip()
-            # self.add_to_history(query, answer)  # Remove if disabling history
-            return f"\nFine-Tuned Hierarchical RAG Answer:\n{answer}"
+            yield "\nFine-Tuned Hierarchical RAG Answer:\n"
+            yield from tokens
+            # History is disabled here; to enable, collect the tokens and call self.add_to_history(query, answer)
         
         except Exception as e:
-            return f"Error processing query: {str(e)}"
+            yield f"Error processing query: {str(e)}"
@@ -1,17 +1,6 @@
-from chroma_utils import query_collections
-from openai import OpenAI
-from dotenv import load_dotenv
-import os
+from chroma_utils import query_collections_batch_async, llm_complete_async, submit_batch, select_context_chunks, summarize_for_history
 from collections import deque
-
-# Load .env file
-load_dotenv()
-
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-except Exception as e:
-    raise ValueError(f"Failed to initialize OpenAI client: {str(e)}")
+import asyncio
 
 class MultiQueryRAG:
     def __init__(self, max_history=5):
@@ -21,17 +10,22 @@ class MultiQueryRAG:
         Args:
             max_history (int): Maximum number of conversation turns to store (default: 5).
         """
-        self.history = deque(maxlen=max_history)  # Stores (queries, response) pairs
+        self.history = deque(maxlen=max_history)  # Preformatted turns, oldest dropped first
+        self._turn = 0  # Running turn number across the rolling window
+        self._history_cache = None  # Rendered history; reset on every add_to_history
+        self.batch_prompts = []  # Prompts queued when fine_tune_mode="batch"
 
     def add_to_history(self, queries, response):
         """
-        Adds queries and response to the conversation history.
+        Adds queries and a truncated response to the conversation history, keeping prompts small.
         
         Args:
             queries (list): List of user queries.
             response (str): RAG response (raw or fine-tuned).
         """
-        self.history.append((queries, response))
+        self._turn += 1
+        self.history.append(f"Turn {self._turn} - Queries: {', '.join(queries)}\nResponse: {summarize_for_history(response)}\n\n")
+        self._history_cache = None
 
     def get_history_context(self):
         """
@@ -42,70 +36,133 @@ class MultiQueryRAG:
         """
         if not self.history:
             return ""
-        context = "Conversation History:\n"
-        for i, (queries, response) in enumerate(self.history, 1):
-            context += f"Turn {i} - Queries: {', '.join(queries)}\nResponse: {response}\n\n"
-        return context
+        if self._history_cache is None:
+            self._history_cache = "Conversation History:\n" + "".join(self.history)
+        return self._history_cache
+
+    def submit_pending_batch(self):
+        """
+        Submits prompts queued with fine_tune_mode="batch" as one OpenAI Batch API job.
+        
+        Returns:
+            str: Batch id (collect answers with chroma_utils.collect_batch), or None if nothing was queued.
+        """
+        if not self.batch_prompts:
+            return None
+        batch_id = submit_batch(self.batch_prompts)
+        if batch_id:
+            self.batch_prompts = []
+        return batch_id
 
-    def multi_query_rag(self, queries, collections, top_k=3, fine_tune=False):
+    def multi_query_rag(self, queries, collections, top_k=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
         """
-        Performs Multi-Query RAG, querying ChromaDB collections for multiple queries.
+        Synchronous wrapper around multi_query_rag_async for callers without an event loop.
         
         Args:
             queries (list): List of user questions.
             collections (list): List of ChromaDB collections to query.
             top_k (int): Number of top relevant chunks per query (default: 3).
             fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
         
         Returns:
             str: Raw or fine-tuned RAG response with page references.
         """
+        return asyncio.run(self.multi_query_rag_async(queries, collections, top_k, fine_tune, ctx_top_n, fine_tune_mode))
+
+    async def multi_query_rag_async(self, queries, collections, top_k=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
+        """
+        Performs Multi-Query RAG, querying ChromaDB collections for multiple queries in one batch.
+        
+        Args:
+            queries (list): List of user questions.
+            collections (list): List of ChromaDB collections to query.
+            top_k (int): Number of top relevant chunks per query (default: 3).
+            fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
+        
+        Returns:
+            str: Raw or fine-tuned RAG response with page references.
+        """
+        return "".join([token async for token in self.multi_query_rag_stream(queries, collections, top_k, fine_tune, ctx_top_n, fine_tune_mode)])
+
+    async def multi_query_rag_stream(self, queries, collections, top_k=3, fine_tune=False, ctx_top_n=5, fine_tune_mode="sync"):
+        """
+        Streaming variant of multi_query_rag; yields the response as it is generated.
+        
+        Args:
+            queries (list): List of user questions.
+            collections (list): List of ChromaDB collections to query.
+            top_k (int): Number of top relevant chunks per query (default: 3).
+            fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            ctx_top_n (int): Number of highest-ranked chunks passed to the LLM as context (default: 5).
+            fine_tune_mode (str): "sync" to call the LLM immediately, or "batch" to queue the prompt for the OpenAI Batch API (default: "sync").
+        
+        Yields:
+            str: Fragments of the response; LLM tokens are yielded as they arrive.
+        """
         try:
             if not collections:
-                return "No document collections available to query."
+                yield "No document collections available to query."
+                return
             if not queries:
-                return "No queries provided."
+                yield "No queries provided."
+                return
             
-            # Query collections and deduplicate chunks
-            chunk_ids = set()
+            # Query collections and deduplicate chunks, assigning each chunk to its best-matching query
             all_results = []
-            context = ""
-            raw_response = ""
-            for query in queries:
-                results = query_collections(query, collections, top_k)
+            context_parts = []
+            raw_parts = []
+            results_list = await query_collections_batch_async(queries, collections, top_k, hybrid=True)
+            best = {}
+            for results in results_list:
+                for res in results:
+                    chunk_id = res.chunk_id
+                    cur = best.get(chunk_id)
+                    if cur is None or res.similarity > cur.similarity:
+                        best[chunk_id] = res
+            # Only the top ctx_top_n chunks go into the LLM context to keep input tokens down
+            context_ids = {r.chunk_id for r in select_context_chunks("; ".join(queries), list(best.values()), ctx_top_n)}
+            for query, results in zip(queries, results_list):
                 if not results:
-                    raw_response += f"\nQuery: {query}\nNo relevant documents found.\n"
+                    raw_parts.append(f"\nQuery: {query}\nNo relevant documents found.\n")
                     continue
                 
-                raw_response += f"\nQuery: {query}\n"
+                raw_parts.append(f"\nQuery: {query}\n")
                 print(f"\nRetrieved Chunks for Query: {query}")
                 query_results = []
                 for i, res in enumerate(results):
-                    chunk_id = res["metadata"]["chunk_id"]
-                    if chunk_id in chunk_ids:
+                    chunk_id = res.chunk_id
+                    if best.get(chunk_id) is not res:
                         continue
-                    chunk_ids.add(chunk_id)
+                    del best[chunk_id]
                     query_results.append(res)
-                    doc = res["document"]
-                    similarity = res["similarity"]
-                    page_numbers = res["metadata"].get("page_numbers", [])
-                    page_ref = f"Pages {', '.join(map(str, page_numbers))}" if page_numbers else "No page info"
+                    doc = res.doc
+                    similarity = res.similarity
+                    page_ref = res.page_ref
                     print(f"Chunk {i+1} (Cosine Similarity: {similarity:.3f}, {page_ref}):")
                     print(f"{doc[:200]}..." if len(doc) > 200 else doc)
                     print("-" * 50)
                     chunk_text = f"Chunk {chunk_id} (Similarity: {similarity:.3f}, {page_ref}):\n{doc}\n"
-                    raw_response += chunk_text
-                    context += f"Query: {query}\nDocument {chunk_id} ({page_ref}): {doc}\n\n"
+                    raw_parts.append(chunk_text)
+                    if chunk_id in context_ids:
+                        context_parts.append(f"Query: {query}\nDocument {chunk_id} ({page_ref}): {doc}\n\n")
                 all_results.extend(query_results)
+            raw_response = "".join(raw_parts)
+            context = "".join(context_parts)
             
             if not all_results:
                 self.add_to_history(queries, raw_response)
-                return f"\nRaw Multi-Query RAG Response:\n\n{raw_response}"
+                yield f"\nRaw Multi-Query RAG Response:\n\n{raw_response}"
+                return
             
             # If fine_tune is False, return raw response
             if not fine_tune:
                 self.add_to_history(queries, raw_response)
-                return f"\nRaw Multi-Query RAG Response:\n{raw_response}\n"
+                yield f"\nRaw Multi-Query RAG Response:\n{raw_response}\n"
+                return
                 
             # If fine_tune is True, construct prompt
             history_context = self.get_history_context()
@@ -120,18 +177,23 @@ class MultiQueryRAG:
                         and conversation history, referencing relevant page numbers if applicable:
                         """
             
-            # Generate response using LLM
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                
-                max_tokens=1000,
-                temperature=1000.7
-            )
+            # Queue for the OpenAI Batch API instead of calling the LLM now
+            if fine_tune_mode == "batch":
+                self.batch_prompts.append(prompt)
+                yield f"\nQueued for batch generation as request-{len(self.batch_prompts) - 1}"
+                return
+
+            # Generate response using LLM, streaming tokens as they arrive
+            tokens = await llm_complete_async(prompt, stream=True)
             
-            answer = response.choices[0].message.content.strip()
+            yield "\nFine-Tuned Multi-Query RAG Answer:\n"
+            answer_parts = []
+            async for token in tokens:
+                answer_parts.append(token)
+                yield token
+            yield "\n"
+            answer = "".join(answer_parts).strip()
             self.add_to_history(queries, answer)
-            return f"\nFine-Tuned Multi-Query RAG Answer:\n{answer}\n"
             
         except Exception as e:
-            return f"Error processing queries: {str(e)}"
\ No newline at end of file
+            yield f"Error processing queries: {str(e)}"
\ No newline at end of file
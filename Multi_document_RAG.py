@@ -1,17 +1,7 @@
-from chroma_utils import query_collections
-from openai import OpenAI
-from dotenv import load_dotenv
-import os
-from collections import deque
-
-# Load .env file
-load_dotenv()
-
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-except Exception as e:
-    raise ValueError(f"Failed to initialize OpenAI client: {str(e)}")
+from chroma_utils import query_all_docs, embed_query, llm_complete_async
+from collections import deque, OrderedDict
+import asyncio
+from semantic_cache import SemanticCache
 
 class MultiDocumentRAG:
     def __init__(self, max_history=5):
@@ -21,7 +11,12 @@ class MultiDocumentRAG:
         Args:
             max_history (int): Maximum number of conversation turns to store (default: 5).
         """
-        self.history = deque(maxlen=max_history)  # Stores (query, response) pairs
+        self.history = deque(maxlen=max_history)  # Preformatted turns, oldest dropped first
+        self._turn = 0  # Running turn number across the rolling window
+        self._history_cache = None  # Rendered history; reset on every add_to_history
+        self._results_cache = OrderedDict()  # (query, collection names, top_k) -> retrieved chunks
+        self.results_cache_size = 256
+        self.semantic_cache = SemanticCache()  # Answers reused for paraphrased queries over the same collections
 
     def add_to_history(self, query, response):
         """
@@ -31,7 +26,9 @@ class MultiDocumentRAG:
             query (str): User query.
             response (str): RAG response (raw or fine-tuned).
         """
-        self.history.append((query, response))
+        self._turn += 1
+        self.history.append(f"Turn {self._turn} - Query: {query}\nResponse: {response}\n\n")
+        self._history_cache = None
 
     def get_history_context(self):
         """
@@ -42,12 +39,53 @@ class MultiDocumentRAG:
         """
         if not self.history:
             return ""
-        context = "Conversation History:\n"
-        for i, (query, response) in enumerate(self.history, 1):
-            context += f"Turn {i} - Query: {query}\nResponse: {response}\n\n"
-        return context
+        if self._history_cache is None:
+            self._history_cache = "Conversation History:\n" + "".join(self.history)
+        return self._history_cache
+
+    def retrieve(self, query, collections, top_k=3, query_embedding=None):
+        """
+        Queries the collections, reusing results for repeated queries over the same collections.
+        Collections are named by PDF hash, so their contents are fixed between uploads.
+        
+        Args:
+            query (str): User question.
+            collections (list): List of ChromaDB collections (one per PDF).
+            top_k (int): Number of top relevant chunks to retrieve (default: 3).
+            query_embedding (sequence): Precomputed query embedding, embedded on demand if None (default: None).
+        
+        Returns:
+            list: Retrieved chunks.
+        """
+        key = (query, tuple(collection.name for collection in collections), top_k)
+        results = self._results_cache.get(key)
+        if results is not None:
+            self._results_cache.move_to_end(key)
+            return results
+        results = query_all_docs(query, collections, top_k, query_embedding)
+        if results:
+            self._results_cache[key] = results
+            if len(self._results_cache) > self.results_cache_size:
+                self._results_cache.popitem(last=False)
+        return results
 
-    def multi_document_rag(self, query, collections, top_k=3, fine_tune=False):
+    def multi_document_rag(self, query, collections, top_k=3, fine_tune=False, show_debug=False):
+        """
+        Synchronous wrapper around multi_document_rag_async for callers without an event loop.
+        
+        Args:
+            query (str): User question.
+            collections (list): List of ChromaDB collections (one per PDF).
+            top_k (int): Number of top relevant chunks to retrieve (default: 3).
+            fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            show_debug (bool): If True, print retrieved chunks to stdout (default: False).
+        
+        Returns:
+            str: Raw or fine-tuned RAG response with page and document references.
+        """
+        return asyncio.run(self.multi_document_rag_async(query, collections, top_k, fine_tune, show_debug))
+
+    async def multi_document_rag_async(self, query, collections, top_k=3, fine_tune=False, show_debug=False):
         """
         Performs Multi-Document RAG, querying across multiple PDF collections.
         
@@ -56,52 +94,79 @@ class MultiDocumentRAG:
             collections (list): List of ChromaDB collections (one per PDF).
             top_k (int): Number of top relevant chunks to retrieve (default: 3).
             fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            show_debug (bool): If True, print retrieved chunks to stdout (default: False).
         
         Returns:
             str: Raw or fine-tuned RAG response with page and document references.
         """
+        return "".join([token async for token in self.multi_document_rag_stream(query, collections, top_k, fine_tune, show_debug)])
+
+    async def multi_document_rag_stream(self, query, collections, top_k=3, fine_tune=False, show_debug=False):
+        """
+        Streaming variant of multi_document_rag; yields the response as it is generated.
+        
+        Args:
+            query (str): User question.
+            collections (list): List of ChromaDB collections (one per PDF).
+            top_k (int): Number of top relevant chunks to retrieve (default: 3).
+            fine_tune (bool): If True, fine-tune with OpenAI (default: False).
+            show_debug (bool): If True, print retrieved chunks to stdout (default: False).
+        
+        Yields:
+            str: Fragments of the response; LLM tokens are yielded as they arrive.
+        """
         try:
             if not collections:
-                return "No document collections available to query."
+                yield "No document collections available to query."
+                return
             if not query:
-                return "No query provided."
+                yield "No query provided."
+                return
+            
+            # Embed once; the vector serves both retrieval and the semantic cache lookup
+            query_embedding = await asyncio.to_thread(embed_query, query)
+            
+            # Serve a cached answer for a semantically equivalent query before retrieval and the LLM call;
+            # the answer was generated under a conversation history, so the history is part of the cache scope
+            if fine_tune:
+                scope = (tuple(collection.name for collection in collections), self.get_history_context())
+                answer = self.semantic_cache.get(query_embedding, scope)
+                if answer is not None:
+                    yield f"\nFine-Tuned Multi-Document RAG Answer:\n{answer}"
+                    self.add_to_history(query, answer)
+                    return
             
             # Query collections
-            results = query_collections(query, collections, top_k)
+            results = await asyncio.to_thread(self.retrieve, query, collections, top_k, query_embedding)
             if not results:
-                return "No relevant documents found for the query."
+                yield "No relevant documents found for the query."
+                return
             
             # Group results by filename and construct raw response
-            raw_response = ""
-            context = ""
-            chunk_ids = set()
-            print(f"\nRetrieved Chunks for Query: {query}")
+            raw_parts = []
+            context_parts = []
+            if show_debug:
+                print(f"\nRetrieved Chunks for Query: {query}")
             for i, result in enumerate(results):
-                chunk_id = result["metadata"]["chunk_id"]
-                if chunk_id in chunk_ids:
-                    continue
-                chunk_ids.add(chunk_id)
-                doc = result["document"]
-                metadata = result["metadata"]
-                similarity = result["similarity"]
-                page_numbers = metadata.get("page_numbers", [])
-                filename = metadata.get("filename", "unknown")
-                page_ref = f"Pages {', '.join(map(str, page_numbers))}" if page_numbers else "No page info"
-                print(f"Chunk {i+1} (Cosine Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):")
-                print(f"{doc[:200]}..." if len(doc) > 200 else doc)
-                print("-" * 50)
+                doc = result.doc
+                similarity = result.similarity
+                filename = result.filename
+                page_ref = result.page_ref
+                if show_debug:
+                    print(f"Chunk {i+1} (Cosine Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):")
+                    print(f"{doc[:200]}..." if len(doc) > 200 else doc)
+                    print("-" * 50)
                 chunk_text = f"Chunk {i+1} (Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):\n{doc}\n"
-                raw_response += chunk_text
-                context += f"Document {i+1} ({page_ref}, PDF: {filename}):\n{doc}\n\n"
-            
-            if not chunk_ids:
-                self.add_to_history(query, raw_response)
-                return f"\nRaw Multi-Document RAG Response:\n{raw_response}\nNote: If relevant content is in images (e.g., graphs), consider OCR for text extraction."
+                raw_parts.append(chunk_text)
+                context_parts.append(f"Document {i+1} ({page_ref}, PDF: {filename}):\n{doc}\n\n")
+            raw_response = "".join(raw_parts)
+            context = "".join(context_parts)
             
             # If fine_tune is False, return raw response
             if not fine_tune:
                 self.add_to_history(query, raw_response)
-                return f"\nRaw Multi-Document RAG Response:\n{raw_response}"
+                yield f"\nRaw Multi-Document RAG Response:\n{raw_response}"
+                return
             
             # If fine_tune is True, construct prompt
             history_context = self.get_history_context()
@@ -117,17 +182,16 @@ class MultiDocumentRAG:
                                 Note that some PDFs may contain images (e.g., graphs) not included in the context:
                         """
             
-            # Generate response using OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=1000,
-                temperature=0.7
-            )
-            
-            answer = response.choices[0].message.content.strip()
+            yield "\nFine-Tuned Multi-Document RAG Answer:\n"
+            # Generate response using OpenAI, streaming tokens as they arrive
+            tokens = await llm_complete_async(prompt, stream=True)
+            answer_parts = []
+            async for token in tokens:
+                answer_parts.append(token)
+                yield token
+            answer = "".join(answer_parts).strip()
+            self.semantic_cache.put(query_embedding, answer, scope)
             self.add_to_history(query, answer)
-            return f"\nFine-Tuned Multi-Document RAG Answer:\n{answer}"
         
         except Exception as e:
-            return f"Error processing query: {str(e)}"
\ No newline at end of file
+            yield f"Error processing query: {str(e)}"
\ No newline at end of file
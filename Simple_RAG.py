@@ -1,16 +1,5 @@
 from chroma_utils import query_collections
-from openai import OpenAI
-from dotenv import load_dotenv
-import os
-
-# Load .env file
-load_dotenv()
-
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-except Exception as e:
-    raise ValueError(f"Failed to initialize OpenAI client: {str(e)}")
+from clients import openai_client as client
 
 class SimpleRAG:
     @staticmethod
@@ -43,11 +32,9 @@ class SimpleRAG:
             context = ""
             print("\nRetrieved Chunks:")
             for i, result in enumerate(results):
-                doc = result["document"]
-                metadata = result["metadata"]
-                similarity = result["similarity"]
-                page_numbers = metadata.get("page_numbers", [])
-                page_ref = f"Pages {', '.join(map(str, page_numbers))}" if page_numbers else "No page info"
+                doc = result.doc
+                similarity = result.similarity
+                page_ref = result.page_ref
                 print(f"Chunk {i+1} (Cosine Similarity: {similarity:.3f}, {page_ref}):")
                 #print(f"{doc[:200]}..." if len(doc) > 200 else doc)
                 print(doc)
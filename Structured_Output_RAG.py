@@ -1,19 +1,9 @@
-from chroma_utils import query_collections
-from openai import OpenAI
-from dotenv import load_dotenv
-import os
+from chroma_utils import query_all_docs_async, embed_query, llm_complete_async, extract_json
 from collections import deque
+from itertools import chain
 import json
-import re
-
-# Load .env file
-load_dotenv()
-
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-except Exception as e:
-    raise ValueError(f"Failed to initialize OpenAI client: {str(e)}")
+import asyncio
+from semantic_cache import SemanticCache
 
 class StructuredOutputRAG:
     def __init__(self, max_history=5):
@@ -23,7 +13,10 @@ class StructuredOutputRAG:
         Args:
             max_history (int): Maximum number of conversation turns to store (default: 5).
         """
-        self.history = deque(maxlen=max_history)  # Stores (query, response) pairs; remove if not needed
+        self.history = deque(maxlen=max_history)  # Preformatted turns, oldest dropped first; remove if not needed
+        self._turn = 0  # Running turn number across the rolling window
+        self._history_cache = None  # Rendered history; reset on every add_to_history
+        self.semantic_cache = SemanticCache()  # Validated JSON answers reused for paraphrased queries
 
     def add_to_history(self, query, response):
         """
@@ -33,7 +26,9 @@ class StructuredOutputRAG:
             query (str): User query.
             response (str): RAG response (raw or fine-tuned).
         """
-        self.history.append((query, response))
+        self._turn += 1
+        self.history.append(f"Turn {self._turn} - Query: {query}\nResponse: {response}\n\n")
+        self._history_cache = None
 
     def get_history_context(self):
         """
@@ -44,12 +39,27 @@ class StructuredOutputRAG:
         """
         if not self.history:
             return ""
-        context = "Conversation History:\n"
-        for i, (query, response) in enumerate(self.history, 1):
-            context += f"Turn {i} - Query: {query}\nResponse: {response}\n\n"
-        return context
+        if self._history_cache is None:
+            self._history_cache = "Conversation History:\n" + "".join(self.history)
+        return self._history_cache
 
-    def structured_output_rag(self, query, collections, top_k=3, fine_tune=False):
+    def structured_output_rag(self, query, collections, top_k=3, fine_tune=False, show_debug=False):
+        """
+        Synchronous wrapper around structured_output_rag_async for callers without an event loop.
+        
+        Args:
+            query (str): User question.
+            collections (list): List of ChromaDB collections (one per PDF).
+            top_k (int): Number of top relevant chunks to retrieve (default: 3).
+            fine_tune (bool): If True, use LLM for structured output; if False, direct JSON structuring (default: False).
+            show_debug (bool): If True, print retrieved chunks and raw LLM output to stdout (default: False).
+        
+        Returns:
+            str: Structured JSON response (direct or LLM-generated).
+        """
+        return asyncio.run(self.structured_output_rag_async(query, collections, top_k, fine_tune, show_debug))
+
+    async def structured_output_rag_async(self, query, collections, top_k=3, fine_tune=False, show_debug=False):
         """
         Performs Structured Output RAG with toggleable direct or LLM-based JSON structuring.
         
@@ -58,66 +68,91 @@ class StructuredOutputRAG:
             collections (list): List of ChromaDB collections (one per PDF).
             top_k (int): Number of top relevant chunks to retrieve (default: 3).
             fine_tune (bool): If True, use LLM for structured output; if False, direct JSON structuring (default: False).
+            show_debug (bool): If True, print retrieved chunks and raw LLM output to stdout (default: False).
         
         Returns:
             str: Structured JSON response (direct or LLM-generated).
         """
+        return "".join([token async for token in self.structured_output_rag_stream(query, collections, top_k, fine_tune, show_debug)])
+
+    async def structured_output_rag_stream(self, query, collections, top_k=3, fine_tune=False, show_debug=False):
+        """
+        Streaming variant of structured_output_rag; yields the response as it is generated.
+        
+        Args:
+            query (str): User question.
+            collections (list): List of ChromaDB collections (one per PDF).
+            top_k (int): Number of top relevant chunks to retrieve (default: 3).
+            fine_tune (bool): If True, use LLM for structured output; if False, direct JSON structuring (default: False).
+            show_debug (bool): If True, print retrieved chunks and raw LLM output to stdout (default: False).
+        
+        Yields:
+            str: Fragments of the response; LLM tokens are yielded as they arrive and the JSON is validated at end of stream.
+        """
         try:
             if not collections:
-                return "No document collections available to query."
+                yield "No document collections available to query."
+                return
             if not query:
-                return "No query provided."
+                yield "No query provided."
+                return
+            
+            # Embed once; the vector serves both retrieval and the semantic cache lookup
+            query_embedding = await asyncio.to_thread(embed_query, query)
+            
+            # Serve a cached answer for a semantically equivalent query before retrieval and the LLM call;
+            # the answer was generated under a conversation history, so the history is part of the cache scope
+            if fine_tune:
+                scope = (tuple(collection.name for collection in collections), self.get_history_context())
+                cached_answer = self.semantic_cache.get(query_embedding, scope)
+                if cached_answer is not None:
+                    yield f"\nStructured Output RAG Response:\n{json.dumps(json.loads(cached_answer), indent=2)}"
+                    return
             
             # Retrieval
-            results = query_collections(query, collections, top_k)
+            results = await query_all_docs_async(query, collections, top_k, query_embedding)
             if not results:
-                return "No relevant documents found for the query."
+                yield "No relevant documents found for the query."
+                return
             
             # Construct context and raw response
-            raw_response = ""
-            context = ""
-            chunk_ids = set()
-            print(f"\nRetrieved Chunks for Query: {query}")
+            raw_parts = []
+            context_parts = []
+            if show_debug:
+                print(f"\nRetrieved Chunks for Query: {query}")
             for i, result in enumerate(results):
-                chunk_id = result["metadata"]["chunk_id"]
-                if chunk_id in chunk_ids:
-                    continue
-                chunk_ids.add(chunk_id)
-                doc = result["document"]
-                metadata = result["metadata"]
-                similarity = result["similarity"]
-                page_numbers = metadata.get("page_numbers", [])
-                filename = metadata.get("filename", "unknown")
-                page_ref = f"Pages {', '.join(map(str, page_numbers))}" if page_numbers else "No page info"
+                doc = result.doc
+                similarity = result.similarity
+                filename = result.filename
+                page_ref = result.page_ref
                 # print(f"Chunk {i+1} (Cosine Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):")
                 # print(f"{doc[:200]}..." if len(doc) > 200 else doc)
                 # print("-" * 50)
                 chunk_text = f"Chunk {i+1} (Similarity: {similarity:.3f}, {page_ref}, PDF: {filename}):\n{doc}\n"
-                raw_response += chunk_text
-                context += f"Document {i+1} ({page_ref}, PDF: {filename}):\n{doc}\n\n"
-            
-            if not chunk_ids:
-                # self.add_to_history(query, raw_response)  # Remove if disabling history
-                return f"\nRaw Structured Output RAG Response:\n{raw_response}\nNote: If relevant content is in images (e.g., graphs), consider OCR for text extraction."
+                raw_parts.append(chunk_text)
+                context_parts.append(f"Document {i+1} ({page_ref}, PDF: {filename}):\n{doc}\n\n")
+            raw_response = "".join(raw_parts)
+            context = "".join(context_parts)
             
             # Direct structuring when fine_tune=False
             if not fine_tune:
                 # Use the highest similarity chunk for summary, aggregate pages and source
-                best_result = max(results, key=lambda x: x["similarity"])
-                summary = best_result["document"][:200] + "..." if len(best_result["document"]) > 200 else best_result["document"]
-                all_pages = [page for result in results for page in result["metadata"]["page_numbers"]]
-                source = best_result["metadata"]["filename"]
+                best_result = results[0]  # Retrieval returns chunks sorted by similarity
+                summary = best_result.doc[:200] + "..." if len(best_result.doc) > 200 else best_result.doc
+                all_pages = list(dict.fromkeys(chain.from_iterable(result.page_numbers for result in results)))
+                source = best_result.filename
                 structured_response = {
                     "question": query,
                     "answer": {
                         "summary": summary,
                         "details": raw_response,  # Raw chunks as details for simplicity
-                        "pages": list(set(all_pages)),  # Deduplicated page numbers
+                        "pages": all_pages,  # Deduplicated page numbers, in retrieval order
                         "source": source
                     }
                 }
                 # self.add_to_history(query, json.dumps(structured_response))  # Remove if disabling history
-                return f"\nStructured Output RAG Response:\n{json.dumps(structured_response, indent=2)}"
+                yield f"\nStructured Output RAG Response:\n{json.dumps(structured_response, indent=2)}"
+                return
             
             # LLM structuring when fine_tune=True
             history_context = self.get_history_context()  # Remove if disabling history
@@ -141,29 +176,31 @@ class StructuredOutputRAG:
                             Ensure the response is valid JSON and references the retrieved context accurately.
                               Note that some PDFs may contain images (e.g., graphs) not included in the context:
                         """
-        
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=1000,
-                temperature=0.7
-            )
+
+            # Generate structured response using OpenAI, streaming tokens as they arrive
+            tokens = await llm_complete_async(prompt, stream=True)
             
-            structured_answer = response.choices[0].message.content.strip()
-            print(f"Raw LLM Response: {structured_answer}")  # Debug log
+            yield "\nStructured Output RAG Response:\n"
+            answer_parts = []
+            async for token in tokens:
+                answer_parts.append(token)
+                yield token
+            structured_answer = "".join(answer_parts).strip()
+            if show_debug:
+                print(f"Raw LLM Response: {structured_answer}")  # Debug log
             
-            # Extract JSON using regex to handle potential extra text
-            json_match = re.search(r'\{.*\}', structured_answer, re.DOTALL)
-            if json_match:
-                structured_answer = json_match.group(0).strip()
+            # Extract the JSON object to handle potential extra text
+            json_str = extract_json(structured_answer)
+            if json_str:
+                structured_answer = json_str
             
             try:
-                # Validate JSON
-                parsed_json = json.loads(structured_answer)
+                # Validate JSON once the stream is complete
+                json.loads(structured_answer)
+                self.semantic_cache.put(query_embedding, structured_answer, scope)
                 # self.add_to_history(query, structured_answer)  # Remove if disabling history
-                return f"\nStructured Output RAG Response:\n{json.dumps(parsed_json, indent=2)}"
             except json.JSONDecodeError as e:
-                return f"\nError: Invalid JSON response from LLM:\n{structured_answer}\nError Details: {str(e)}"
+                yield f"\n\nError: Invalid JSON response from LLM\nError Details: {str(e)}"
         
         except Exception as e:
-            return f"Error processing query: {str(e)}"
+            yield f"Error processing query: {str(e)}"
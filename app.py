@@ -6,30 +6,51 @@ from Structured_Output_RAG import StructuredOutputRAG
 from Agentic_RAG import AgenticRAG
 from Conversational_RAG import ConversationalRAG
 from Hierarchical_RAG import HierarchicalRAG
-from chroma_utils import load_pdfs_from_directory, add_documents
+from chroma_utils import load_pdfs_from_directory, add_documents, extract_json, iter_sync
 import os
+import json
+import logging
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Load .env file
 load_dotenv()
 CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH")
 PDF_Directory = os.getenv("PDF_Directory")
+# chroma_utils logs through `logging`; LOG_LEVEL=INFO or DEBUG in .env for ingest and per-query diagnostics
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 print(PDF_Directory)
 
-# Initialize RAG agents
-simple_rag = SimpleRAG()
-
-multi_query_rag = MultiQueryRAG()
-multi_document_rag = MultiDocumentRAG()
-structured_rag = StructuredOutputRAG(max_history=5)
-agentic_rag = AgenticRAG(max_history=5)
-conversation_rag = ConversationalRAG(max_history=5)
-hierarchical_rag = HierarchicalRAG()
+# RAG agents hold per-user history, pending batch prompts and answer caches, so each browser session gets its own
+# set, reused across reruns; the embedder and API clients they rely on are shared process-wide
+def get_rag_agents():
+    if "rag_agents" not in st.session_state:
+        st.session_state.rag_agents = {
+            "Simple": SimpleRAG(),
+            "Multi Query": MultiQueryRAG(),
+            "Multi Document": MultiDocumentRAG(),
+            "Structured Output": StructuredOutputRAG(max_history=5),
+            "Agentic": AgenticRAG(max_history=5),
+            "Conversation": ConversationalRAG(max_history=5),
+            "Hierarchical": HierarchicalRAG()
+        }
+    return st.session_state.rag_agents
 
 # Streamlit app configuration
 st.set_page_config(page_title="Retreival Aggumented Generation Application", layout="wide")
 st.title("Retreival Aggumented Generation Application")
 
+# Initialize RAG agents
+rag_agents = get_rag_agents()
+simple_rag = rag_agents["Simple"]
+multi_query_rag = rag_agents["Multi Query"]
+multi_document_rag = rag_agents["Multi Document"]
+structured_rag = rag_agents["Structured Output"]
+agentic_rag = rag_agents["Agentic"]
+conversation_rag = rag_agents["Conversation"]
+hierarchical_rag = rag_agents["Hierarchical"]
+
 # Sidebar for controls
 st.sidebar.header("Settings")
 rag_type = st.sidebar.selectbox("Select RAG Type", ["Simple", "Multi Query", "Multi Document", "Structured Output", "Agentic", "Conversation", "Hierarchical"])
@@ -44,15 +65,19 @@ if upload_pdfs:
     directory = PDF_Directory
     if not os.path.exists(directory):
         os.makedirs(directory)
-    collections = []
-    for uploaded_file in upload_pdfs:
+
+    def _ingest(uploaded_file):
         file_path = os.path.join(directory, uploaded_file.name)
+        buf = uploaded_file.getbuffer()
         with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        with open(file_path, "rb") as pdf_file:
-            collection, processed = add_documents(pdf_file, uploaded_file.name)
-            if collection and processed:
-                collections.append(collection)
+            f.write(buf)
+        # Ingest from the in-memory bytes rather than reading the file back from disk
+        collection, processed, _, _ = add_documents(buf, uploaded_file.name)
+        return collection if collection and processed else None
+
+    # Parse and embed the uploaded PDFs concurrently
+    with ThreadPoolExecutor(max_workers=min(8, len(upload_pdfs))) as executor:
+        collections = [collection for collection in executor.map(_ingest, upload_pdfs) if collection]
     st.sidebar.success(f"Processed PDF(s).")
     if collections:
         st.session_state.collections = collections
@@ -61,7 +86,6 @@ if upload_pdfs:
 
 # Clear ChromaDB if requested
 if clear_db:
-    import shutil
     shutil.rmtree(CHROMA_DB_PATH, ignore_errors=True)
     if not os.path.exists(CHROMA_DB_PATH):
         os.makedirs(CHROMA_DB_PATH)
@@ -84,22 +108,21 @@ if st.button("Submit Query"):
         st.error("No document collections available. Ensure PDFs are uploaded or the default PDF is valid. Check debug logs.")
     else:
         with st.spinner("Processing query..."):
-            rag_instance = {
-                "Simple": simple_rag,
-                "Multi Query": multi_query_rag,
-                "Multi Document": multi_document_rag,
-                "Structured Output": structured_rag,
-                "Agentic": agentic_rag,
-                "Conversation": conversation_rag,
-                "Hierarchical": hierarchical_rag
-            }[rag_type]
+            rag_instance = rag_agents[rag_type]
             fine_tune = response_format == "LLM-enhanced"
-            if rag_type in ["Structured Output", "Agentic"]:
-                response = rag_instance.structured_output_rag(query, st.session_state.collections, top_k=3, fine_tune=fine_tune) if rag_type == "Structured Output" else rag_instance.agentic_rag(query, st.session_state.collections, top_k=3, fine_tune=fine_tune)
+            if rag_type in ["Multi Document", "Structured Output"]:
+                stream = rag_instance.multi_document_rag_stream(query, st.session_state.collections, top_k=3, fine_tune=fine_tune, show_debug=show_debug) if rag_type == "Multi Document" else \
+                         rag_instance.structured_output_rag_stream(query, st.session_state.collections, top_k=3, fine_tune=fine_tune, show_debug=show_debug)
+                # Render tokens as they arrive; the placeholder is replaced by the formatted display below
+                placeholder = st.empty()
+                with placeholder.container():
+                    response = st.write_stream(iter_sync(stream))
+                placeholder.empty()
+            elif rag_type == "Agentic":
+                response = rag_instance.agentic_rag(query, st.session_state.collections, top_k=3, fine_tune=fine_tune)
             else:
                 response = rag_instance.simple_rag_func(query, st.session_state.collections) if rag_type == "Simple" else \
                            rag_instance.multi_query_rag(query, st.session_state.collections, top_k=3) if rag_type == "Multi Query" else \
-                           rag_instance.multi_document_rag(query, st.session_state.collections, top_k=3) if rag_type == "Multi Document" else \
                            rag_instance.conversational_rag(query, st.session_state.collections, top_k=3) if rag_type == "Conversation" else \
                            rag_instance.hierarchical_rag(query, st.session_state.collections) if rag_type == "Hierarchical" else ""
             if not response or "No relevant documents found" in response:
@@ -113,24 +136,21 @@ if st.button("Submit Query"):
 
 # Display results
 if "response" in st.session_state:
-    import re
-    import json
-
-    for line in st.session_state.response:
+    response_lines = st.session_state.response
+    for idx, line in enumerate(response_lines):
         if line.startswith("Agent Reasoning:"):
             st.subheader(line)
         elif line.startswith("Retrieved Chunks:"):
             with st.expander("Retrieved Chunks"):
-                for next_line in st.session_state.response[st.session_state.response.index(line) + 1:]:
+                for next_line in response_lines[idx + 1:]:
                     if next_line.startswith("Structured Output") or next_line.startswith("Error"):
                         break
                     st.text(next_line)
         elif line.startswith("Structured Output") or line.startswith("Error"):
             # Extract JSON from the response
-            response_text = "\n".join(st.session_state.response[st.session_state.response.index(line):])
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(0).strip()
+            response_text = "\n".join(response_lines[idx:])
+            json_str = extract_json(response_text)
+            if json_str:
                 try:
                     parsed_json = json.loads(json_str)
                     st.json(parsed_json)
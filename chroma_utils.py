@@ -1,132 +1,225 @@
-import chromadb
-from sentence_transformers import SentenceTransformer
-import PyPDF2
+from sentence_transformers import CrossEncoder
+from rank_bm25 import BM25Okapi
 import os
 from dotenv import load_dotenv
-import hashlib
+from openai import RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+import io
+import json
+import re
 import numpy as np
+import asyncio
+import heapq
+from collections import OrderedDict
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import sys
+from dataclasses import dataclass
+from functools import lru_cache
+from clients import get_chroma_client, openai_client
+from pdf_ingest import get_pdf_hash, encode_chunks, get_pdf_chunks, parse_and_embed_pdfs
 
 # Load .env file
 load_dotenv()
+log = logging.getLogger(__name__)
 PDF_Directory = os.getenv("PDF_Directory")
-# Initialize persistent ChromaDB client
-chroma_client = chromadb.PersistentClient(path=os.getenv("CHROMA_DB_PATH"))
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+# LRU cache of query text -> read-only float32 embedding, shared by every RAG strategy
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+_query_embedding_cache = OrderedDict()
+_query_embedding_lock = threading.Lock()
+# Optional cross-encoder rerank of the chunks passed to the LLM (RERANK_CONTEXT=true in .env)
+RERANK_CONTEXT = os.getenv("RERANK_CONTEXT", "false").lower() == "true"
+_reranker = None
+# Shared pool for fanning one query out across per-PDF collections; Chroma's HNSW search releases the GIL
+QUERY_WORKERS = 16
+_query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+# Multi-PDF queries run as one filtered search over all_docs rather than one search per collection (UNIFIED_QUERY=false in .env to fan out)
+UNIFIED_QUERY = os.getenv("UNIFIED_QUERY", "true").lower() == "true"
+# Hybrid retrieval: fuse dense results with BM25 keyword matches for callers that ask for it (hybrid=True: the agentic
+# and multi-query strategies), on per-collection queries only; HYBRID_SEARCH=false in .env disables it everywhere
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+RRF_K = 60
+_TOKEN_RE = re.compile(r"\w+")
+# Per-collection (BM25Okapi, ids) built once at ingest/first use
+_bm25_indexes = {}
+# Distance metric for new collections; existing collections keep the space they were created with
+HNSW_SPACE = "cosine"
+# HNSW build parameters for per-PDF collections
+PDF_COLLECTION_METADATA = {"hnsw:space": HNSW_SPACE, "hnsw:construction_ef": 100, "hnsw:M": 32}
+# Chroma inserts are sliced into batches of this many chunks
+ADD_BATCH_SIZE = 1000
+# Chroma returns distances, not similarities; map each space back to cosine similarity (embeddings are unit-norm)
+_DISTANCE_TO_SIMILARITY = {
+    "cosine": lambda d: 1 - d,
+    "ip": lambda d: 1 - d,
+    "l2": lambda d: 1 - d / 2,  # squared L2 between unit vectors is 2 - 2*cos
+}
+# Unified index over every PDF so a query is one HNSW traversal; chunks are tagged with their per-PDF collection
+ALL_DOCS_COLLECTION = "all_docs"
+ALL_DOCS_METADATA = {"hnsw:space": HNSW_SPACE, "hnsw:M": 32, "hnsw:search_ef": 128}
+_all_docs = None
+# Responses are truncated to this many characters before being kept in conversation history
+MAX_SUMMARY_CHARS = 512
+# Per-collection stats (page_count, filename) computed once at ingest/first use rather than per query
+collection_stats = {}
 
-def get_pdf_hash(pdf_file):
+@dataclass(slots=True)
+class Chunk:
+    doc: str
+    chunk_id: str
+    page_numbers: tuple
+    filename: str
+    similarity: float
+    page_ref: str
+
+# On-disk map of absolute path -> [mtime, size, pdf_hash], so unchanged PDFs are never re-hashed
+PDF_HASH_CACHE_PATH = ".rag_cache.json"
+
+def load_pdf_hash_cache():
     try:
-        hasher = hashlib.md5()
-        hasher.update(pdf_file.read())
-        return hasher.hexdigest()
-    except Exception as e:
-        print(f"Error generating hash for PDF: {str(e)}")
-        return None
+        with open(PDF_HASH_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+_pdf_hash_cache = load_pdf_hash_cache()
 
-def extract_pdf_text_with_pages(pdf_file):
+def save_pdf_hash_cache():
     try:
-        pdf_file.seek(0)
-        reader = PyPDF2.PdfReader(pdf_file)
-        page_texts = []
-        for page_num in range(len(reader.pages)):
-            text = reader.pages[page_num].extract_text() or ""
-            text = text.strip()
-            page_texts.append((text, page_num + 1))
-            if not text:
-                print(f"Warning: Page {page_num + 1} has no extractable text (possibly image-based content like graphs).")
-            else:
-                print(f"Page {page_num + 1} text length: {len(text)} characters")
-        return page_texts
-    except Exception as e:
-        print(f"Error extracting text from PDF: {str(e)}")
-        return []
+        tmp_path = f"{PDF_HASH_CACHE_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(_pdf_hash_cache, f)
+        os.replace(tmp_path, PDF_HASH_CACHE_PATH)
+    except OSError as e:
+        log.error("Error saving PDF hash cache: %s", e)
 
-def chunk_text(page_texts, max_length=500, overlap=100):
-    chunks = []
-    chunk_metadata = []
-    current_chunk = []
-    current_length = 0
-    current_page_numbers = []
-    word_count = 0
-
-    for text, page_num in page_texts:
-        words = text.split()
-        for word in words:
-            current_length += len(word) + 1
-            current_chunk.append(word)
-            word_count += 1
-            if not current_page_numbers or current_page_numbers[-1] != page_num:
-                current_page_numbers.append(page_num)
-
-            if word_count >= max_length:
-                chunk_text = " ".join(current_chunk)
-                chunks.append(chunk_text)
-                chunk_metadata.append({"page_numbers": current_page_numbers.copy()})
-                current_chunk = current_chunk[-overlap:] if overlap < len(current_chunk) else current_chunk
-                current_length = sum(len(w) + 1 for w in current_chunk)
-                word_count = len(current_chunk)
-                current_page_numbers = current_page_numbers[-1:] if current_page_numbers else []
-        if not current_chunk:
-            current_page_numbers = []
-
-    if current_chunk:
-        chunk_text = " ".join(current_chunk)
-        if chunk_text.strip():
-            chunks.append(chunk_text)
-            chunk_metadata.append({"page_numbers": current_page_numbers})
-
-    return chunks, chunk_metadata
+def get_file_pdf_hash(file_path):
+    # Returns (pdf_hash, cache_updated); the file is only read when its mtime or size changed
+    key = os.path.abspath(file_path)
+    stat = os.stat(key)
+    entry = _pdf_hash_cache.get(key)
+    if entry and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+        return entry[2], False
+    with open(file_path, "rb") as file:
+        pdf_hash = get_pdf_hash(file)
+    if not pdf_hash:
+        return None, False
+    _pdf_hash_cache[key] = [stat.st_mtime, stat.st_size, pdf_hash]
+    return pdf_hash, True
+
+def get_or_create_collection(name, metadata):
+    # Metadata is applied only at creation: Chroma 0.5's get_or_create_collection overwrites the metadata of an
+    # existing collection, while its HNSW index keeps the space it was built with (legacy collections are l2)
+    try:
+        return get_chroma_client().get_collection(name)
+    except ValueError:
+        # get_or_create rather than create: a concurrent ingest thread may have just created it with the same metadata
+        return get_chroma_client().get_or_create_collection(name, metadata=metadata)
+
+def get_pdf_collection(pdf_hash):
+    collection_name = f"pdf_{pdf_hash}"
+    collection = get_or_create_collection(collection_name, PDF_COLLECTION_METADATA)
+    if collection.count() > 0:
+        log.info("Collection %s already exists with %s documents", collection_name, collection.count())
+        sync_all_docs(collection)
+        return collection, False
+    return collection, True
+
+def store_documents(collection, filename, chunks, chunk_metadata, embeddings, ids):
+    metadatas = [
+        {"chunk_id": id, "page_numbers": ",".join(str(p) for p in meta["page_numbers"]), "filename": filename}
+        for id, meta in zip(ids, chunk_metadata)
+    ]
+    
+    try:
+        add_in_batches(collection, chunks, embeddings, ids, metadatas)
+        log.info("Successfully added %s chunks to collection %s", len(chunks), collection.name)
+        build_bm25_index(collection, ids, chunks)
+        add_in_batches(
+            get_all_docs_collection(), chunks, embeddings, ids,
+            [{**meta, "collection": collection.name} for meta in metadatas]
+        )
+        collection_stats[collection.name] = {
+            "page_count": len({p for meta in chunk_metadata for p in meta["page_numbers"]}),
+            "filename": filename
+        }
+        return True
+    except Exception as e:
+        log.error("Error adding to ChromaDB for %s: %s", filename, e)
+        return False
 
 def add_documents(pdf_file, filename):
     try:
+        if isinstance(pdf_file, (bytes, bytearray, memoryview)):
+            pdf_file = io.BytesIO(pdf_file)
         filename = os.path.normpath(filename)
         pdf_file.seek(0)
         pdf_hash = get_pdf_hash(pdf_file)
         if not pdf_hash:
-            print(f"Failed to generate hash for {filename}")
-            return None, False
-        
-        collection_name = f"pdf_{pdf_hash}"
-        collection = chroma_client.get_or_create_collection(collection_name)
+            log.error("Failed to generate hash for %s", filename)
+            return None, False, [], []
         
-        if collection.count() > 0:
-            print(f"Collection {collection_name} already exists with {collection.count()} documents")
-            return collection, False
+        collection, is_new = get_pdf_collection(pdf_hash)
+        if not is_new:
+            return collection, False, [], []
         
-        page_texts = extract_pdf_text_with_pages(pdf_file)
-        if not page_texts:
-            print(f"No text extracted from {filename}. If it contains images (e.g., graphs), consider OCR (e.g., pytesseract).")
-            return collection, False
+        prepared = get_pdf_chunks(pdf_file, filename)
+        if prepared is None:
+            return collection, False, [], []
         
-        chunks, chunk_metadata = chunk_text(page_texts, max_length=500, overlap=100)
-        if not chunks:
-            print(f"No chunks created for {filename}")
-            return collection, False
-        
-        print(f"Created {len(chunks)} chunks for {filename}: {[len(c) for c in chunks]}")
+        chunks, chunk_metadata, embeddings = prepared
         ids = [f"{pdf_hash}_{i}" for i in range(len(chunks))]
-        embeddings = embedder.encode(chunks, show_progress_bar=True).tolist()
-        embedding_norms = [np.linalg.norm(emb) for emb in embeddings]
-        print(f"Embedding norms for {filename}: {embedding_norms}")
-        metadatas = [
-            {"chunk_id": id, "page_numbers": ",".join(str(p) for p in meta["page_numbers"]), "filename": filename}
-            for id, meta in zip(ids, chunk_metadata)
-        ]
-        
+        if not store_documents(collection, filename, chunks, chunk_metadata, embeddings, ids):
+            return collection, False, [], []
+        return collection, True, chunks, ids
+    except Exception as e:
+        log.error("Error processing %s: %s", filename, e)
+        return None, False, [], []
+
+def load_pdf_paths(paths):
+    documents = []
+    ids = []
+    collections = []
+    pending = []
+    cache_updated = False
+    for file_path in paths:
         try:
-            collection.add(
-                documents=chunks,
-                embeddings=embeddings,
-                ids=ids,
-                metadatas=metadatas
-            )
-            print(f"Successfully added {len(chunks)} chunks to collection {collection_name}")
-            return collection, True
+            pdf_hash, updated = get_file_pdf_hash(file_path)
+            cache_updated |= updated
+            if not pdf_hash:
+                log.error("Failed to generate hash for %s", file_path)
+                continue
+            collection, is_new = get_pdf_collection(pdf_hash)
+            if is_new:
+                pending.append((file_path, pdf_hash, collection))
+            else:
+                collections.append(collection)
+        except (FileNotFoundError, OSError) as e:
+            log.error("File %s not found or invalid: %s", file_path, e)
         except Exception as e:
-            print(f"Error adding to ChromaDB for {filename}: {str(e)}")
-            return collection, False
-    except Exception as e:
-        print(f"Error processing {filename}: {str(e)}")
-        return None, False
+            log.error("Error processing %s: %s", file_path, e)
+    if cache_updated:
+        save_pdf_hash_cache()
+    
+    if not pending:
+        return documents, ids, collections
+    
+    # Parse and embed new PDFs (in parallel processes on CPU, one batched encode on GPU); Chroma writes stay here
+    prepared = parse_and_embed_pdfs([file_path for file_path, _, _ in pending])
+    
+    for (file_path, pdf_hash, collection), result in zip(pending, prepared):
+        if result is not None:
+            chunks, chunk_metadata, embeddings = result
+            chunk_ids = [f"{pdf_hash}_{i}" for i in range(len(chunks))]
+            if store_documents(collection, os.path.normpath(os.path.basename(file_path)), chunks, chunk_metadata, embeddings, chunk_ids):
+                documents.extend(chunks)
+                ids.extend(chunk_ids)
+        collections.append(collection)
+    return documents, ids, collections
+
+def list_pdf_paths(directory):
+    return [os.path.join(directory, filename) for filename in os.listdir(directory) if filename.lower().endswith(".pdf")]
 
 def load_pdfs_from_directory(directory):
     documents = []
@@ -136,109 +229,437 @@ def load_pdfs_from_directory(directory):
     try:
         directory = os.path.normpath(directory)
         if not os.path.exists(directory):
-            print(f"Directory {directory} does not exist, attempting to load default PDF.")
+            log.warning("Directory %s does not exist, attempting to load default PDF.", directory)
         else:
-            for filename in os.listdir(directory):
-                if filename.lower().endswith(".pdf"):
-                    file_path = os.path.join(directory, filename)
-                    try:
-                        with open(file_path, "rb") as file:
-                            collection, processed = add_documents(file, filename)
-                            if collection is None:
-                                continue
-                            if processed:
-                                file.seek(0)
-                                chunks, chunk_metadata = chunk_text(extract_pdf_text_with_pages(file))
-                                ids_chunk = [f"{get_pdf_hash(file)}_{j}" for j in range(len(chunks))]
-                                documents.extend(chunks)
-                                ids.extend(ids_chunk)
-                            collections.append(collection)
-                    except (FileNotFoundError, OSError) as e:
-                        print(f"File {file_path} not found or invalid: {str(e)}")
-                    except Exception as e:
-                        print(f"Error processing {file_path}: {str(e)}")
+            documents, ids, collections = load_pdf_paths(list_pdf_paths(directory))
         
         if not collections and os.path.exists(default_pdf):
-            print(f"No collections found, loading default PDF: {default_pdf}")
-            for filename in os.listdir(default_pdf):
-                if filename.lower().endswith(".pdf"):
-                    file_path = os.path.join(default_pdf, filename)
-                    try:
-                        with open(file_path, "rb") as file:
-                            collection, processed = add_documents(file, filename)
-                            if collection is None:
-                                continue
-                            if processed:
-                                file.seek(0)
-                                chunks, chunk_metadata = chunk_text(extract_pdf_text_with_pages(file))
-                                ids_chunk = [f"{get_pdf_hash(file)}_{j}" for j in range(len(chunks))]
-                                documents.extend(chunks)
-                                ids.extend(ids_chunk)
-                            collections.append(collection)
-                    except (FileNotFoundError, OSError) as e:
-                        print(f"File {file_path} not found or invalid: {str(e)}")
-                    except Exception as e:
-                        print(f"Error processing {file_path}: {str(e)}")
+            log.warning("No collections found, loading default PDF: %s", default_pdf)
+            documents, ids, collections = load_pdf_paths(list_pdf_paths(default_pdf))
         
         elif not collections:
-            print("No valid PDFs found or processed, and default PDF is unavailable.")
+            log.warning("No valid PDFs found or processed, and default PDF is unavailable.")
         else:
-            print(f"Loaded {len(documents)} chunks across {len(collections)} collections")
+            log.info("Loaded %s chunks across %s collections", len(documents), len(collections))
         return documents, ids, collections
     except Exception as e:
-        print(f"Error accessing directory {directory}: {str(e)}")
+        log.error("Error accessing directory %s: %s", directory, e)
         if os.path.exists(default_pdf):
-            print(f"Falling back to default PDF: {default_pdf}")
+            log.warning("Falling back to default PDF: %s", default_pdf)
             with open(default_pdf, "rb") as file:
-                collection, processed = add_documents(file, os.path.basename(default_pdf))
+                collection, processed, chunks, chunk_ids = add_documents(file, os.path.basename(default_pdf))
                 if collection and processed:
                     collections.append(collection)
-                    file.seek(0)
-                    chunks, chunk_metadata = chunk_text(extract_pdf_text_with_pages(file))
-                    ids_chunk = [f"{get_pdf_hash(file)}_{j}" for j in range(len(chunks))]
                     documents.extend(chunks)
-                    ids.extend(ids_chunk)
-        return [], [], collections
+                    ids.extend(chunk_ids)
+        return documents, ids, collections
+
+def add_in_batches(collection, documents, embeddings, ids, metadatas, batch_size=ADD_BATCH_SIZE):
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        collection.add(
+            documents=documents[start:end],
+            embeddings=embeddings[start:end],
+            ids=ids[start:end],
+            metadatas=metadatas[start:end]
+        )
+
+def get_all_docs_collection():
+    global _all_docs
+    if _all_docs is None:
+        _all_docs = get_or_create_collection(ALL_DOCS_COLLECTION, ALL_DOCS_METADATA)
+    return _all_docs
+
+def sync_all_docs(collection):
+    # Backfill the unified index for collections ingested before it existed
+    all_docs = get_all_docs_collection()
+    if all_docs.get(where={"collection": collection.name}, limit=1)["ids"]:
+        return
+    data = collection.get(include=["documents", "metadatas", "embeddings"])
+    if data["ids"]:
+        add_in_batches(
+            all_docs, data["documents"], data["embeddings"], data["ids"],
+            [{**meta, "collection": collection.name} for meta in data["metadatas"]]
+        )
+        log.info("Backfilled %s chunks from %s into %s", len(data['ids']), collection.name, ALL_DOCS_COLLECTION)
+
+def get_collection_stats(collection):
+    stats = collection_stats.get(collection.name)
+    if stats is None:
+        metadatas = collection.get(include=["metadatas"])["metadatas"] or []
+        stats = {
+            "page_count": len({p for meta in metadatas for p in parse_page_numbers(meta.get("page_numbers", ""))}),
+            "filename": metadatas[0].get("filename", "unknown") if metadatas else "unknown"
+        }
+        collection_stats[collection.name] = stats
+    return stats
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+def build_bm25_index(collection, ids=None, documents=None):
+    if ids is None:
+        data = collection.get(include=["documents"])
+        ids, documents = data["ids"], data["documents"]
+    index = (BM25Okapi([tokenize(doc) for doc in documents]), ids) if ids else None
+    _bm25_indexes[collection.name] = index
+    return index
+
+def get_bm25_index(collection):
+    if collection.name in _bm25_indexes:
+        return _bm25_indexes[collection.name]
+    return build_bm25_index(collection)
+
+def sparse_search(query, query_embedding, collections, top_k=3):
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    query_vec = np.asarray(query_embedding, dtype=np.float32)
+    query_norm = np.linalg.norm(query_vec) or 1.0
+    scored = []
+    for collection in collections:
+        index = get_bm25_index(collection)
+        if index is None:
+            continue
+        bm25, ids = index
+        scores = bm25.get_scores(tokens)
+        top = [i for i in heapq.nlargest(top_k, range(len(ids)), key=scores.__getitem__) if scores[i] > 0]
+        if not top:
+            continue
+        # Hydrate only the BM25 winners; similarity is the same cosine the dense path reports
+        data = collection.get(ids=[ids[i] for i in top], include=["documents", "metadatas", "embeddings"])
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        similarities = (embeddings @ query_vec / (np.linalg.norm(embeddings, axis=1) * query_norm)).tolist()
+        bm25_scores = {ids[i]: scores[i] for i in top}
+        for chunk_id, chunk in zip(data["ids"], parse_query_results(data["documents"], data["metadatas"], similarities)):
+            scored.append((bm25_scores[chunk_id], chunk))
+    return [chunk for _, chunk in heapq.nlargest(top_k, scored, key=lambda x: x[0])]
+
+def reciprocal_rank_fusion(ranked_lists, top_k=3, k=RRF_K):
+    scores = {}
+    chunks = {}
+    for ranked in ranked_lists:
+        for rank, chunk in enumerate(ranked, 1):
+            scores[chunk.chunk_id] = scores.get(chunk.chunk_id, 0.0) + 1.0 / (k + rank)
+            chunks.setdefault(chunk.chunk_id, chunk)
+    return [chunks[chunk_id] for chunk_id in heapq.nlargest(top_k, scores, key=scores.__getitem__)]
+
+def rank_results(query, query_embedding, results, collections, top_k=3, hybrid=False):
+    # Returns at most top_k chunks, deduplicated by chunk_id and sorted by similarity (best first)
+    best = {}
+    for result in results:
+        cur = best.get(result.chunk_id)
+        if cur is None or result.similarity > cur.similarity:
+            best[result.chunk_id] = result
+    if not (hybrid and HYBRID_SEARCH):
+        return heapq.nlargest(top_k, best.values(), key=lambda x: x.similarity)
+    dense = sorted(best.values(), key=lambda x: x.similarity, reverse=True)
+    fused = reciprocal_rank_fusion([dense, sparse_search(query, query_embedding, collections, top_k)], top_k)
+    return sorted(fused, key=lambda x: x.similarity, reverse=True)
+
+def get_reranker():
+    global _reranker
+    if _reranker is None:
+        _reranker = CrossEncoder("BAAI/bge-reranker-base")
+    return _reranker
+
+def select_context_chunks(query, results, ctx_top_n=5):
+    if RERANK_CONTEXT and results:
+        scores = get_reranker().predict([(query, result.doc) for result in results])
+        ranked = heapq.nlargest(ctx_top_n, range(len(results)), key=lambda i: scores[i])
+        return [results[i] for i in ranked]
+    return heapq.nlargest(ctx_top_n, results, key=lambda x: x.similarity)
 
-def query_collections(query, collections, top_k=3):
+def embed_queries(queries):
+    with _query_embedding_lock:
+        missing = list(dict.fromkeys(q for q in queries if q not in _query_embedding_cache))
+    computed = dict(zip(missing, encode_chunks(missing))) if missing else {}
+    for emb in computed.values():
+        emb.flags.writeable = False  # Rows are shared by every cache hit
+    with _query_embedding_lock:
+        _query_embedding_cache.update(computed)
+        embeddings = []
+        for q in queries:
+            emb = computed[q] if q in computed else _query_embedding_cache[q]
+            _query_embedding_cache[q] = emb
+            _query_embedding_cache.move_to_end(q)
+            embeddings.append(emb)
+        while len(_query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+            _query_embedding_cache.popitem(last=False)
+    return embeddings
+
+def embed_query(query):
+    return embed_queries([query])[0]
+
+def summarize_for_history(response):
+    return response if len(response) <= MAX_SUMMARY_CHARS else response[:MAX_SUMMARY_CHARS] + "..."
+
+def distances_to_similarities(collection, distances):
+    space = (collection.metadata or {}).get("hnsw:space", "l2")
+    assert space in _DISTANCE_TO_SIMILARITY, f"Unsupported hnsw:space {space!r} for collection {collection.name}"
+    convert = _DISTANCE_TO_SIMILARITY[space]
+    # One vectorized conversion; a missing distance (None -> NaN) scores 0 as before
+    return np.nan_to_num(convert(np.asarray(distances, dtype=np.float64)), nan=0.0).tolist()
+
+def extract_json(text):
+    # Linear balanced-brace scan for the first JSON object; braces inside strings are ignored
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+@lru_cache(maxsize=4096)
+def parse_page_numbers(page_numbers):
+    # Chroma 0.5 metadata values must be scalars, so page lists are stored comma-joined; each distinct string is parsed once
+    return tuple(int(p) for p in page_numbers.split(",") if p)
+
+@lru_cache(maxsize=4096)
+def format_page_ref(page_numbers):
+    return f"Pages {', '.join(map(str, page_numbers))}" if page_numbers else "No page info"
+
+def parse_query_results(documents, metadatas, similarities):
+    chunks = []
+    for doc, meta, sim in zip(documents, metadatas, similarities):
+        page_numbers = parse_page_numbers(meta["page_numbers"])
+        chunks.append(Chunk(
+            doc=doc,
+            chunk_id=sys.intern(meta["chunk_id"]),  # Interned so dedupe lookups compare by identity
+            page_numbers=page_numbers,
+            filename=meta.get("filename", "unknown"),
+            similarity=sim,
+            page_ref=format_page_ref(page_numbers)
+        ))
+    return chunks
+
+def query_each_collection(collections, query_embeddings, top_k=3):
+    # Independent HNSW searches, one per collection, run concurrently; results keep the collections' order
+    def query_one(collection):
+        return collection.query(
+            query_embeddings=query_embeddings,
+            n_results=top_k,
+            include=["documents", "metadatas", "distances"]
+        )
+    if len(collections) == 1:
+        return [query_one(collections[0])]
+    return list(_query_executor.map(query_one, collections))
+
+def query_all_docs_results(collections, query_embeddings, top_k=3):
+    # One query over the unified index, restricted to the given per-PDF collections
+    all_docs = get_all_docs_collection()
+    return all_docs, all_docs.query(
+        query_embeddings=query_embeddings,
+        n_results=top_k,
+        where={"collection": {"$in": [collection.name for collection in collections]}},
+        include=["documents", "metadatas", "distances"]
+    )
+
+def uses_all_docs(collections):
+    return UNIFIED_QUERY and len(collections) > 1
+
+def query_sources(collections, query_embeddings, top_k=3):
+    # (collection, query_results) pairs: a single all_docs search when several PDFs are queried, else per collection
+    if uses_all_docs(collections):
+        return [query_all_docs_results(collections, query_embeddings, top_k)]
+    return list(zip(collections, query_each_collection(collections, query_embeddings, top_k)))
+
+def query_collections(query, collections, top_k=3, hybrid=False):
     try:
-        print(f"Query: {query}")
-        query_embedding = embedder.encode([query]).tolist()
-        query_norm = np.linalg.norm(query_embedding[0])
-        print(f"Query embedding norm: {query_norm}")
+        query_embedding = embed_query(query)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Query: %s", query)
+            log.debug("Query embedding norm: %s", np.linalg.norm(query_embedding))
         results = []
-        for collection in collections:
-            query_results = collection.query(
-                query_embeddings=query_embedding,
-                n_results=top_k,
-                include=["documents", "metadatas", "distances"]
-            )
+        for collection, query_results in query_sources(collections, query_embedding[None, :], top_k):
             documents = query_results["documents"][0]
             metadatas = query_results["metadatas"][0]
             distances = query_results["distances"][0]
-            print(f"Raw distances for collection {collection.name}: {distances}")
-            print(f"Document lengths: {[len(doc) for doc in documents]}")
-            print(f"Document previews: {[doc[:50] + '...' for doc in documents]}")
-            similarities = [1 - dist / 2 if dist is not None else 0 for dist in distances]
-            print(f"Calculated similarities (1 - dist/2): {[1 - d / 2 for d in distances]}")
-            print(f"Normalized similarities: {similarities}")
-            parsed_results = [
-                {
-                    "document": doc,
-                    "metadata": {
-                        "chunk_id": meta["chunk_id"],
-                        "page_numbers": [int(p) for p in meta["page_numbers"].split(",") if p],
-                        "filename": meta.get("filename", "unknown")
-                    },
-                    "similarity": sim
-                }
-                for doc, meta, sim in zip(documents, metadatas, similarities)
-            ]
-            results.extend(parsed_results)
-        results = sorted(results, key=lambda x: x["similarity"], reverse=True)[:top_k]
+            similarities = distances_to_similarities(collection, distances)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Raw distances for collection %s: %s", collection.name, distances)
+                log.debug("Document lengths: %s", [len(doc) for doc in documents])
+                log.debug("Document previews: %s", [doc[:50] + '...' for doc in documents])
+                log.debug("Cosine similarities: %s", similarities)
+            results.extend(parse_query_results(documents, metadatas, similarities))
+        # BM25 is per collection, so it would bring back the fan-out the unified all_docs search avoids
+        results = rank_results(query, query_embedding, results, collections, top_k, hybrid and not uses_all_docs(collections))
         if not results:
-            print("No results returned from query.")
+            log.debug("No results returned from query.")
         return results
     except Exception as e:
-        print(f"Error querying collections: {str(e)}")
-        return []
\ No newline at end of file
+        log.error("Error querying collections: %s", e)
+        return []
+
+async def query_collections_async(query, collections, top_k=3, hybrid=False):
+    return await asyncio.to_thread(query_collections, query, collections, top_k, hybrid)
+
+def query_all_docs(query, collections, top_k=3, query_embedding=None):
+    try:
+        # Callers that already embedded the query (e.g. for a semantic cache lookup) pass it in
+        if query_embedding is None:
+            query_embedding = embed_query(query)
+        all_docs, query_results = query_all_docs_results(collections, np.asarray(query_embedding, dtype=np.float32)[None, :], top_k)
+        similarities = distances_to_similarities(all_docs, query_results["distances"][0])
+        results = parse_query_results(query_results["documents"][0], query_results["metadatas"][0], similarities)
+        return rank_results(query, query_embedding, results, collections, top_k)
+    except Exception as e:
+        log.error("Error querying %s: %s", ALL_DOCS_COLLECTION, e)
+        return []
+
+async def query_all_docs_async(query, collections, top_k=3, query_embedding=None):
+    return await asyncio.to_thread(query_all_docs, query, collections, top_k, query_embedding)
+
+def query_collections_batch(queries, collections, top_k=3, hybrid=False):
+    try:
+        log.debug("Batch queries: %s", queries)
+        if not queries:
+            return []
+        query_embeddings = np.stack(embed_queries(queries))
+        per_query_results = [[] for _ in queries]
+        for collection, query_results in query_sources(collections, query_embeddings, top_k):
+            for i, (documents, metadatas, distances) in enumerate(zip(
+                query_results["documents"], query_results["metadatas"], query_results["distances"]
+            )):
+                similarities = distances_to_similarities(collection, distances)
+                per_query_results[i].extend(parse_query_results(documents, metadatas, similarities))
+        hybrid = hybrid and not uses_all_docs(collections)
+        return [
+            rank_results(query, query_embedding, results, collections, top_k, hybrid)
+            for query, query_embedding, results in zip(queries, query_embeddings, per_query_results)
+        ]
+    except Exception as e:
+        log.error("Error batch querying collections: %s", e)
+        return [[] for _ in queries]
+
+async def query_collections_batch_async(queries, collections, top_k=3, hybrid=False):
+    return await asyncio.to_thread(query_collections_batch, queries, collections, top_k, hybrid)
+
+@retry(wait=wait_exponential(), stop=stop_after_attempt(3), retry=retry_if_exception_type(RateLimitError), reraise=True)
+def _create_chat_completion(**kwargs):
+    return openai_client.chat.completions.create(**kwargs)
+
+def llm_complete(prompt, *, model="gpt-4o-mini", max_tokens=1000, temperature=0.7, stream=False):
+    response = _create_chat_completion(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=stream
+    )
+    if stream:
+        return iter_stream_tokens(response)
+    return response.choices[0].message.content.strip()
+
+async def _create_chat_completion_async(**kwargs):
+    # The shared sync client (and its keep-alive pool) serves async callers too, from a worker thread:
+    # every asyncio.run gets a fresh loop, which a loop-bound AsyncOpenAI pool could not outlive
+    return await asyncio.to_thread(_create_chat_completion, **kwargs)
+
+async def llm_complete_async(prompt, *, model="gpt-4o-mini", max_tokens=1000, temperature=0.7, stream=False):
+    response = await _create_chat_completion_async(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=stream
+    )
+    if stream:
+        return aiter_stream_tokens(response)
+    return response.choices[0].message.content.strip()
+
+def iter_stream_tokens(response):
+    for chunk in response:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+async def aiter_stream_tokens(response):
+    # Each read blocks on the socket, so chunks are pulled off the event loop one at a time
+    tokens = iter_stream_tokens(response)
+    done = object()
+    try:
+        while (token := await asyncio.to_thread(next, tokens, done)) is not done:
+            yield token
+    finally:
+        response.close()
+
+def iter_sync(async_gen):
+    # Drives an async generator from sync code (e.g. st.write_stream) on a private event loop
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(async_gen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(async_gen.aclose())
+        loop.close()
+
+def submit_batch(prompts, model="gpt-4o-mini", max_tokens=1000, temperature=0.7):
+    try:
+        requests = [
+            json.dumps({
+                "custom_id": f"request-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "messages": [{"role": "user", "content": prompt}],
+                    "max_tokens": max_tokens,
+                    "temperature": temperature
+                }
+            })
+            for i, prompt in enumerate(prompts)
+        ]
+        batch_file = openai_client.files.create(
+            file=("batch_requests.jsonl", "\n".join(requests).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = openai_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        log.info("Submitted batch %s with %s requests", batch.id, len(prompts))
+        return batch.id
+    except Exception as e:
+        log.error("Error submitting batch: %s", e)
+        return None
+
+def collect_batch(batch_id):
+    try:
+        batch = openai_client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            log.warning("Batch %s is not complete yet (status: %s)", batch_id, batch.status)
+            return None
+        output = openai_client.files.content(batch.output_file_id).text
+        answers = {}
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            body = item["response"]["body"]
+            answers[item["custom_id"]] = body["choices"][0]["message"]["content"].strip()
+        return answers
+    except Exception as e:
+        log.error("Error collecting batch %s: %s", batch_id, e)
+        return None
\ No newline at end of file
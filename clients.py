@@ -0,0 +1,39 @@
+import chromadb
+import httpx
+import threading
+from openai import OpenAI
+from dotenv import load_dotenv
+import os
+
+# Load .env file
+load_dotenv()
+
+# ChromaDB client shared by every RAG strategy: a `chroma run` server when CHROMA_HOST is set in .env
+# (one store shared by every process, no per-process index load), otherwise the embedded persistent store
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+_chroma_client = None
+_chroma_client_lock = threading.Lock()
+
+def get_chroma_client():
+    # Opened on first use: spawned ingest workers re-import the launching script (and so this module)
+    # but never touch Chroma, so they must not open the persistent store
+    global _chroma_client
+    with _chroma_client_lock:
+        if _chroma_client is None:
+            if CHROMA_HOST:
+                _chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=int(os.getenv("CHROMA_PORT", "8000")))
+            else:
+                _chroma_client = chromadb.PersistentClient(path=os.getenv("CHROMA_DB_PATH"))
+        return _chroma_client
+
+# OpenAI client shared by every RAG strategy; one httpx pool keeps connections alive across modules.
+# Built-in retries are off: rate limits are retried once, by the tenacity policy on chroma_utils._create_chat_completion
+try:
+    openai_client = OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=0,
+        timeout=30.0,
+        http_client=httpx.Client(limits=httpx.Limits(max_keepalive_connections=20, max_connections=100))
+    )
+except Exception as e:
+    raise ValueError(f"Failed to initialize OpenAI client: {str(e)}")
@@ -0,0 +1,44 @@
+from functools import lru_cache
+import torch
+from sentence_transformers import SentenceTransformer
+from dotenv import load_dotenv
+import os
+
+try:
+    import streamlit as st
+    from streamlit import runtime as streamlit_runtime
+except ImportError:
+    st = None
+
+# Load .env file
+load_dotenv()
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# On CPU, optionally run an INT8-quantized ONNX export through ONNX Runtime (EMBEDDING_BACKEND=onnx in .env)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+# Quantized exports shipped in the model repo; pick the one matching the CPU (avx2, avx512, avx512_vnni, arm64)
+ONNX_MODEL_FILE = os.getenv("ONNX_MODEL_FILE", "onnx/model_quint8_avx2.onnx")
+
+def embedding_backend():
+    # Runtime and precision get_embedder() loads; part of the key for anything caching its embeddings
+    if torch.cuda.is_available():
+        return "torch-fp16-cuda"
+    if EMBEDDING_BACKEND == "onnx":
+        return f"onnx:{ONNX_MODEL_FILE}"
+    return "torch-fp32-cpu"
+
+def _load_embedder(name=EMBEDDING_MODEL):
+    # Run on the GPU in FP16 when one is available; CPU stays FP32 unless the ONNX backend is selected
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cpu" and EMBEDDING_BACKEND == "onnx":
+        return SentenceTransformer(name, device=device, backend="onnx", model_kwargs={"file_name": ONNX_MODEL_FILE})
+    model = SentenceTransformer(name, device=device)
+    if device == "cuda":
+        model.half()
+    return model
+
+# One SentenceTransformer per process: shared across reruns and sessions under Streamlit, memoized otherwise
+if st is not None and streamlit_runtime.exists():
+    get_embedder = st.cache_resource(show_spinner=False)(_load_embedder)
+else:
+    get_embedder = lru_cache(maxsize=1)(_load_embedder)
@@ -7,8 +7,11 @@ from Hierarchical_RAG import HierarchicalRAG
 from Structured_Output_RAG import StructuredOutputRAG
 from Agentic_RAG import AgenticRAG
 import os
+import logging
 
 def main():
+    # chroma_utils logs through `logging`; LOG_LEVEL=INFO or DEBUG in .env for ingest and per-query diagnostics
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
     print("Main Program")
     input_pdf_source = r"D:\PythonProject\RAG_PROJECT\pdfs\the_hindu_marriage_act_1955.pdf"
     multi_doc_directory = r"D:\PythonProject\RAG_PROJECT\pdfs"
@@ -115,7 +118,7 @@ def Test_Multi_Query_RAG(pdf_path,queries, fine_tune=False):
     try:
         pdf_path = os.path.normpath(pdf_path)
         with open(pdf_path, "rb") as file:
-            collection, processed = add_documents(file, os.path.basename(pdf_path))
+            collection, processed, _, _ = add_documents(file, os.path.basename(pdf_path))
             if collection:
                 print(f"Processed: {processed}, Documents in collection: {collection.count()}")
                 rag = MultiQueryRAG(max_history=5)
@@ -135,13 +138,13 @@ def TestSinglePDF(pdf_path):
         # Normalize path for Windows
         pdf_path = os.path.normpath(pdf_path)
         with open(pdf_path, "rb") as file:
-            collection, processed = add_documents(file, os.path.basename(pdf_path))
+            collection, processed, _, _ = add_documents(file, os.path.basename(pdf_path))
             if collection:
                 print(f"Processed: {processed}, Documents in collection: {collection.count()}")
                 results = query_collections("What is the Hindu Marriage Act?", [collection], top_k=3)
                 for result in results:
-                    print(f"Document: {result['document'][:50]}...")
-                    print(f"Metadata: {result['metadata']}")
+                    print(f"Document: {result.doc[:50]}...")
+                    print(f"Metadata: chunk_id={result.chunk_id}, pages={result.page_numbers}, filename={result.filename}")
             else:
                 print(f"Failed to process {pdf_path}")
     except (FileNotFoundError, OSError) as e:
@@ -155,7 +158,7 @@ def Test_Simple_RAG(pdf_path,query,k,finetune,temperature,maxtokens):
         # Normalize path for Windows
         pdf_path = os.path.normpath(pdf_path)
         with open(pdf_path, "rb") as file:
-            collection, processed = add_documents(file, os.path.basename(pdf_path))
+            collection, processed, _, _ = add_documents(file, os.path.basename(pdf_path))
             if collection:
                 print(f"Processed: {processed}, Documents in collection: {collection.count()}")
                 # Test Simple RAG
@@ -174,7 +177,7 @@ def Test_Conversational_RAG(pdf_path, fine_tune=False):
         # Normalize path for Windows
         pdf_path = os.path.normpath(pdf_path)
         with open(pdf_path, "rb") as file:
-            collection, processed = add_documents(file, os.path.basename(pdf_path))
+            collection, processed, _, _ = add_documents(file, os.path.basename(pdf_path))
             if collection:
                 print(f"Processed: {processed}, Documents in collection: {collection.count()}")
                 # Initialize Conversational RAG
@@ -202,8 +205,8 @@ def TestDirectory():
     print(f"Loaded {len(documents)} chunks across {len(collections)} collections")
     results = query_collections("test query", collections, top_k=3)
     for result in results:
-        print(f"Document: {result['document'][:50]}...")
-        print(f"Metadata: {result['metadata']}")
+        print(f"Document: {result.doc[:50]}...")
+        print(f"Metadata: chunk_id={result.chunk_id}, pages={result.page_numbers}, filename={result.filename}")
 
 
 
@@ -0,0 +1,168 @@
+import pypdfium2 as pdfium
+import hashlib
+import logging
+import threading
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from embedder import get_embedder
+
+log = logging.getLogger(__name__)
+
+HASH_READ_SIZE = 1 << 20
+
+def get_pdf_hash(pdf_file):
+    try:
+        # Hash in 1 MiB reads so large PDFs are never held in memory whole
+        hasher = hashlib.md5()
+        pdf_file.seek(0)
+        for block in iter(lambda: pdf_file.read(HASH_READ_SIZE), b""):
+            hasher.update(block)
+        pdf_file.seek(0)
+        return hasher.hexdigest()
+    except Exception as e:
+        log.error("Error generating hash for PDF: %s", e)
+        return None
+
+# PDFium is not thread-safe, even across separate documents; uploads are ingested from a thread pool
+_pdfium_lock = threading.Lock()
+
+def extract_pdf_text_with_pages(pdf_file):
+    with _pdfium_lock:
+        return _extract_pdf_text_with_pages(pdf_file)
+
+def _extract_pdf_text_with_pages(pdf_file):
+    try:
+        pdf_file.seek(0)
+        # PDFium (C++) extraction; pypdfium2 reads file objects without copying them
+        pdf = pdfium.PdfDocument(pdf_file)
+        page_texts = []
+        try:
+            for page_num in range(len(pdf)):
+                page = pdf[page_num]
+                textpage = page.get_textpage()
+                text = textpage.get_text_range().strip()
+                textpage.close()
+                page.close()
+                page_texts.append((text, page_num + 1))
+                if not text:
+                    log.warning("Page %s has no extractable text (possibly image-based content like graphs).", page_num + 1)
+                else:
+                    log.debug("Page %s text length: %s characters", page_num + 1, len(text))
+        finally:
+            pdf.close()
+        return page_texts
+    except Exception as e:
+        log.error("Error extracting text from PDF: %s", e)
+        return []
+
+def chunk_text(page_texts, max_length=500, overlap=100):
+    chunks = []
+    chunk_metadata = []
+    # Flatten once: every word, plus the word index where each non-empty page ends
+    page_words = [(words, page_num) for words, page_num in ((text.split(), page_num) for text, page_num in page_texts) if words]
+    all_words = [word for words, _ in page_words for word in words]
+    if not all_words:
+        return chunks, chunk_metadata
+    page_nums = [page_num for _, page_num in page_words]
+    page_ends = np.cumsum([len(words) for words, _ in page_words])
+
+    # Fixed windows of max_length words, each starting max_length - overlap words after the previous one
+    stride = max(1, max_length - overlap)
+    starts = []
+    for start in range(0, len(all_words), stride):
+        starts.append(start)
+        if start + max_length >= len(all_words):
+            break
+    starts = np.array(starts)
+    ends = np.minimum(starts + max_length, len(all_words))
+    # Pages spanned by each window: the pages holding its first and last word, and every page between
+    first_pages = np.searchsorted(page_ends, starts, side="right")
+    last_pages = np.searchsorted(page_ends, ends - 1, side="right")
+    for start, end, first, last in zip(starts.tolist(), ends.tolist(), first_pages.tolist(), last_pages.tolist()):
+        chunks.append(" ".join(all_words[start:end]))
+        chunk_metadata.append({"page_numbers": page_nums[first:last + 1]})
+
+    return chunks, chunk_metadata
+
+def encode_chunks(chunks, batch_size=128):
+    # SentenceTransformer.encode already orders inputs by length and restores the original order,
+    # so each mini-batch pads only to similar-length chunks; unit-norm float32 regardless of model precision
+    # The model loads on first use, so imports that never embed skip it
+    return get_embedder().encode(
+        chunks, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+    ).astype(np.float32, copy=False)
+
+def parse_pdf(pdf_file, filename):
+    page_texts = extract_pdf_text_with_pages(pdf_file)
+    if not page_texts:
+        log.warning("No text extracted from %s. If it contains images (e.g., graphs), consider OCR (e.g., pytesseract).", filename)
+        return None
+    
+    chunks, chunk_metadata = chunk_text(page_texts, max_length=500, overlap=100)
+    if not chunks:
+        log.warning("No chunks created for %s", filename)
+        return None
+    
+    log.info("Created %s chunks for %s", len(chunks), filename)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Chunk lengths for %s: %s", filename, [len(c) for c in chunks])
+    return chunks, chunk_metadata
+
+def get_pdf_chunks(pdf_file, filename):
+    parsed = parse_pdf(pdf_file, filename)
+    if parsed is None:
+        return None
+    chunks, chunk_metadata = parsed
+    return chunks, chunk_metadata, encode_chunks(chunks)
+
+def _process_pdf_path(path, process):
+    try:
+        with open(path, "rb") as file:
+            return process(file, os.path.normpath(os.path.basename(path)))
+    except Exception as e:
+        log.error("Error processing %s: %s", path, e)
+        return None
+
+def parse_and_embed_pdf(path):
+    # Directory-ingest worker, run in a spawned process: this module does not import clients, and the Chroma
+    # client opens lazily, so a worker never opens the persistent store; all Chroma writes stay in the parent
+    return _process_pdf_path(path, get_pdf_chunks)
+
+def set_worker_threads(num_threads):
+    # Each worker gets its share of the cores; torch's default intra-op pool would claim all of them per process
+    torch.set_num_threads(num_threads)
+
+def parse_and_embed_pdfs(paths):
+    # Returns (chunks, chunk_metadata, embeddings) or None per path, in order
+    if len(paths) == 1:
+        return [parse_and_embed_pdf(paths[0])]
+    if torch.cuda.is_available():
+        # One GPU: per-process models would each need their own CUDA context and FP16 copy, so parse here
+        # and embed every file's chunks in a single batched encode
+        parsed = [_process_pdf_path(path, parse_pdf) for path in paths]
+        all_chunks = [chunk for result in parsed if result is not None for chunk in result[0]]
+        embeddings = encode_chunks(all_chunks) if all_chunks else None
+        prepared = []
+        offset = 0
+        for result in parsed:
+            if result is None:
+                prepared.append(None)
+                continue
+            chunks, chunk_metadata = result
+            prepared.append((chunks, chunk_metadata, embeddings[offset:offset + len(chunks)]))
+            offset += len(chunks)
+        return prepared
+    # CPU: each PDF is independent, so parse and embed them in parallel processes
+    # (spawn rather than fork: the parent's Chroma client is not fork-safe)
+    cpu_count = os.cpu_count() or 1
+    workers = min(cpu_count, len(paths))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=set_worker_threads,
+        initargs=(max(1, cpu_count // workers),)
+    ) as executor:
+        return list(executor.map(parse_and_embed_pdf, paths))
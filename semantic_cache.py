@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import faiss
+except ImportError:  # Fall back to a brute-force NumPy scan over the cached embeddings
+    faiss = None
+
+class SemanticCache:
+    def __init__(self, dim=384, threshold=0.95, maxsize=500, ttl=3600, candidates=4):
+        """
+        Initializes a semantic cache mapping query embeddings to previously generated LLM answers.
+
+        Args:
+            dim (int): Embedding dimension (default: 384 for all-MiniLM-L6-v2).
+            threshold (float): Minimum cosine similarity for a cache hit (default: 0.95).
+            maxsize (int): Maximum number of cached answers; least recently used are evicted first (default: 500).
+            ttl (int): Seconds before a cached answer expires (default: 3600).
+            candidates (int): Nearest neighbours checked per lookup, so scope mismatches can fall through (default: 4).
+        """
+        self.dim = dim
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.candidates = candidates
+        self._entries = OrderedDict()  # entry id -> (embedding, scope, answer, timestamp), in LRU order
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._index = faiss.IndexIDMap(faiss.IndexFlatIP(dim)) if faiss is not None else None
+        self._matrix = None  # NumPy fallback: stacked embeddings, rebuilt after any change
+        self._matrix_ids = []
+
+    @staticmethod
+    def _normalize(embedding):
+        vec = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _search(self, vec):
+        k = min(self.candidates, len(self._entries))
+        if self._index is not None:
+            scores, ids = self._index.search(vec, k)
+            return [(int(i), float(s)) for i, s in zip(ids[0], scores[0]) if i != -1]
+        if self._matrix is None:
+            self._matrix_ids = list(self._entries)
+            self._matrix = np.vstack([self._entries[i][0] for i in self._matrix_ids])
+        scores = self._matrix @ vec[0]
+        top = np.argpartition(scores, -k)[-k:]
+        return [(self._matrix_ids[i], float(scores[i])) for i in top[np.argsort(scores[top])[::-1]]]
+
+    def _remove(self, entry_id):
+        del self._entries[entry_id]
+        if self._index is not None:
+            self._index.remove_ids(np.array([entry_id], dtype=np.int64))
+        self._matrix = None
+
+    def get(self, embedding, scope=None):
+        """
+        Looks up a cached answer for a semantically equivalent query.
+
+        Args:
+            embedding (sequence): Query embedding.
+            scope (hashable): Extra key the cached answer must match, e.g. the queried collection names.
+
+        Returns:
+            str: Cached answer, or None on a miss.
+        """
+        vec = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            if not self._entries:
+                return None
+            for entry_id, score in self._search(vec):
+                if score < self.threshold:
+                    break
+                _, entry_scope, answer, timestamp = self._entries[entry_id]
+                if now - timestamp > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                if entry_scope != scope:
+                    continue
+                self._entries.move_to_end(entry_id)
+                return answer
+        return None
+
+    def put(self, embedding, answer, scope=None):
+        """
+        Caches an answer under its query embedding.
+
+        Args:
+            embedding (sequence): Query embedding.
+            answer (str): Generated answer.
+            scope (hashable): Extra key a later lookup must match.
+        """
+        vec = self._normalize(embedding)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (vec[0], scope, answer, time.time())
+            if self._index is not None:
+                self._index.add_with_ids(vec, np.array([entry_id], dtype=np.int64))
+            self._matrix = None
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))